@@ -85,7 +85,8 @@ class HistoryList(MyTreeWidget, AcceptFileDragDrop):
 
     def get_domain(self):
         '''Replaced in address_dialog.py'''
-        return self.wallet.get_addresses()
+        # the whole wallet, see Abstract_Wallet.get_history
+        return None
 
     def on_combo(self, x):
         s = self.period_combo.itemText(x)
@@ -67,7 +67,7 @@ class NodesListWidget(QTreeWidget):
     def __init__(self, parent):
         QTreeWidget.__init__(self)
         self.parent = parent
-        self.setHeaderLabels([_('Connected node'), _('Height')])
+        self.setHeaderLabels([_('Connected node'), _('Height'), _('Latency')])
         self.setContextMenuPolicy(Qt.CustomContextMenu)
         self.customContextMenuRequested.connect(self.create_menu)
 
@@ -113,7 +113,8 @@ class NodesListWidget(QTreeWidget):
                 x = self
             for i in items:
                 star = ' *' if i == network.interface else ''
-                item = QTreeWidgetItem([i.host + star, '%d'%i.tip])
+                rtt = i.get_stats()['rtt']
+                item = QTreeWidgetItem([i.host + star, '%d'%i.tip, '%d ms'%(rtt*1000) if rtt is not None else ''])
                 item.setData(0, Qt.UserRole, 0)
                 item.setData(1, Qt.UserRole, i.server)
                 x.addChild(item)
@@ -125,6 +126,7 @@ class NodesListWidget(QTreeWidget):
         h.setStretchLastSection(False)
         h.setSectionResizeMode(0, QHeaderView.Stretch)
         h.setSectionResizeMode(1, QHeaderView.ResizeToContents)
+        h.setSectionResizeMode(2, QHeaderView.ResizeToContents)
 
 
 class ServerListWidget(QTreeWidget):
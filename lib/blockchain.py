@@ -21,13 +21,19 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import mmap
+import struct
+import hashlib
 import threading
-from time import sleep
+import time
+from bisect import insort, bisect_left
+from collections import OrderedDict
 
 from . import util
 from . import bitcoin
 from . import constants
 from .bitcoin import *
+from .equihash import get_equihash
 
 HDR_LEN = 1487
 HDR_EH_192_7_LEN = 543
@@ -47,6 +53,12 @@ POST_BUTTERCUP_POW_TARGET_SPACING = 75
 
 TARGET_CALC_BLOCKS = POW_AVERAGING_WINDOW + POW_MEDIAN_BLOCK_SPAN
 
+# header index record: hash, merkle root, version, timestamp, bits
+INDEX_RECORD = struct.Struct('<32s32sIII')
+INDEX_RECORD_LEN = INDEX_RECORD.size
+# index records built at once, by fill_index or by read_index
+INDEX_FILL_LEN = 10 * CHUNK_LEN
+
 def get_pow_target_spacing(height):
     if height >= BUTTERCUP_ACTIVATION_HEIGHT:
         return POST_BUTTERCUP_POW_TARGET_SPACING
@@ -61,6 +73,27 @@ def get_min_actual_timespan(height):
 def get_max_actual_timespan(height):
     return get_averaging_window_timespan(height) * (100 + POW_MAX_ADJUST_DOWN) // 100
 
+def calculate_target(height, target_sum, median_time, past_median_time):
+    '''DigiShield v3 target from the sum of the last POW_AVERAGING_WINDOW
+    targets and the median times at height and POW_AVERAGING_WINDOW
+    blocks earlier'''
+    mean_target = target_sum // POW_AVERAGING_WINDOW
+    actual_timespan = median_time - past_median_time
+    actual_timespan = get_averaging_window_timespan(height) + \
+        int((actual_timespan - get_averaging_window_timespan(height)) / \
+            POW_DAMPING_FACTOR)
+    if actual_timespan < get_min_actual_timespan(height):
+        actual_timespan = get_min_actual_timespan(height)
+    elif actual_timespan > get_max_actual_timespan(height):
+        actual_timespan = get_max_actual_timespan(height)
+
+    next_target = mean_target // get_averaging_window_timespan(height) * actual_timespan
+
+    if next_target > MAX_TARGET:
+        next_target = MAX_TARGET
+
+    return next_target
+
 def is_post_equihash_fork(height):
     return height >= BUBBLES_ACTIVATION_HEIGHT
 
@@ -69,7 +102,109 @@ def get_header_size(height):
         return HDR_EH_192_7_LEN
     return HDR_LEN
 
+def get_equihash_params(height):
+    return (192, 7) if is_post_equihash_fork(height) else (200, 9)
+
+class BlockHeader(object):
+    '''A serialized block header.  Fields are decoded from the raw bytes
+    when accessed; read access is the same as for the dicts that
+    deserialize_header used to return.'''
+
+    __slots__ = ('raw', 'block_height', '_hash', '_values')
+
+    # field -> (decoder, start, end)
+    FIELDS = OrderedDict([
+        ('version', (lambda s: struct.unpack_from('<I', s)[0], 0, 4)),
+        ('prev_block_hash', (hash_encode, 4, 36)),
+        ('merkle_root', (hash_encode, 36, 68)),
+        ('reserved_hash', (hash_encode, 68, 100)),
+        ('timestamp', (lambda s: struct.unpack_from('<I', s)[0], 100, 104)),
+        ('bits', (lambda s: struct.unpack_from('<I', s)[0], 104, 108)),
+        ('nonce', (hash_encode, 108, 140)),
+        ('sol_size', (hash_encode, 140, 143)),
+        ('solution', (hash_encode, 143, None)),
+    ])
+
+    def __init__(self, raw, height):
+        self.raw = raw
+        self.block_height = height
+        self._hash = None
+        self._values = None
+
+    def hash(self):
+        if self._hash is None:
+            self._hash = hash_encode(Hash(self.raw))
+        return self._hash
+
+    def copy(self):
+        header = BlockHeader(self.raw, self.block_height)
+        header._hash = self._hash
+        return header
+
+    def __getitem__(self, key):
+        if key == 'block_height':
+            return self.block_height
+        if self._values is None:
+            self._values = {}
+        value = self._values.get(key)
+        if value is None:
+            decode, start, end = self.FIELDS[key]
+            value = self._values[key] = decode(self.raw[start:end])
+        return value
+
+    def __setitem__(self, key, value):
+        if key == 'block_height':
+            self.block_height = value
+            return
+        d = dict(self)
+        d[key] = value
+        self.raw = bfh(serialize_header(d))
+        self._hash = None
+        self._values = None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key == 'block_height' or key in self.FIELDS
+
+    def keys(self):
+        return list(self.FIELDS) + ['block_height']
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def __len__(self):
+        return len(self.FIELDS) + 1
+
+    def __eq__(self, other):
+        if isinstance(other, BlockHeader):
+            return self.raw == other.raw and self.block_height == other.block_height
+        return isinstance(other, dict) and dict(self) == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<BlockHeader %d %s>' % (self.block_height, self.hash())
+
+
+def header_to_bytes(header):
+    if isinstance(header, BlockHeader):
+        return header.raw
+    return bfh(serialize_header(header))
+
 def serialize_header(res):
+    if isinstance(res, BlockHeader):
+        return bh2u(res.raw)
     s = int_to_hex(res.get('version'), 4) \
         + rev_hex(res.get('prev_block_hash')) \
         + rev_hex(res.get('merkle_root')) \
@@ -86,28 +221,94 @@ def deserialize_header(s, height):
         raise Exception('Invalid header: {}'.format(s))
     if len(s) != get_header_size(height):
         raise Exception('Invalid header length: {}'.format(len(s)))
-    hex_to_int = lambda s: int('0x' + bh2u(s[::-1]), 16)
-    h = {}
-    h['version'] = hex_to_int(s[0:4])
-    h['prev_block_hash'] = hash_encode(s[4:36])
-    h['merkle_root'] = hash_encode(s[36:68])
-    h['reserved_hash'] = hash_encode(s[68:100])
-    h['timestamp'] = hex_to_int(s[100:104])
-    h['bits'] = hex_to_int(s[104:108])
-    h['nonce'] = hash_encode(s[108:140])
-    h['sol_size'] = hash_encode(s[140:143])
-    h['solution'] = hash_encode(s[143:])
-    h['block_height'] = height
-    return h
+    return BlockHeader(bytes(s), height)
 
 def hash_header(header):
     if header is None:
         return '0' * 64
+    if isinstance(header, BlockHeader):
+        return header.hash()
     if header.get('prev_block_hash') is None:
         header['prev_block_hash'] = '00'*32
     return hash_encode(Hash(bfh(serialize_header(header))))
 
+def hash_chunk(height, data, check_pow=()):
+    '''Hashes of the serialized headers in data, starting at height.
+    The equihash solutions of the headers at the positions in check_pow
+    are verified too.  Context free, so that it can run in a worker
+    process.'''
+    data = memoryview(data)
+    check_pow = set(check_pow)
+    hashes = []
+    offset = 0
+    while offset < len(data):
+        header_size = get_header_size(height)
+        raw_header = data[offset:offset+header_size]
+        if len(raw_header) != header_size:
+            raise Exception('Invalid header length: {}'.format(len(raw_header)))
+        if len(hashes) in check_pow and not verify_equihash(raw_header, height):
+            raise Exception('Invalid equihash solution at height {}'.format(height))
+        hashes.append(hash_encode(hashlib.sha256(hashlib.sha256(raw_header).digest()).digest()))
+        offset += header_size
+        height += 1
+    return hashes
+
+def verify_equihash(raw_header, height):
+    return get_equihash(*get_equihash_params(height)).verify_header(raw_header)
+
+def index_record(raw):
+    '''Index record of a serialized header.  Missing (zeroed) headers
+    get a zeroed record.'''
+    if raw == bytes(len(raw)):
+        return bytes(INDEX_RECORD_LEN)
+    _hash = hashlib.sha256(hashlib.sha256(raw).digest()).digest()
+    version, = struct.unpack_from('<I', raw, 0)
+    timestamp, bits = struct.unpack_from('<II', raw, 100)
+    return INDEX_RECORD.pack(_hash, bytes(raw[36:68]), version, timestamp, bits)
+
+
+class HeaderCache(object):
+    '''LRU of deserialized headers, keyed by (branch checkpoint, height).
+    Shared by all branches.'''
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.headers = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, checkpoint, height):
+        key = checkpoint, height
+        with self.lock:
+            header = self.headers.get(key)
+            if header is None:
+                self.misses += 1
+                return
+            self.hits += 1
+            self.headers.move_to_end(key)
+        # callers may modify the header they get
+        return header.copy()
+
+    def put(self, checkpoint, height, header):
+        with self.lock:
+            self.headers[(checkpoint, height)] = header.copy()
+            if len(self.headers) > self.size:
+                self.headers.popitem(last=False)
+
+    def invalidate(self, checkpoint):
+        '''Drop the headers of the branch starting at checkpoint'''
+        with self.lock:
+            for key in [k for k in self.headers if k[0] == checkpoint]:
+                del self.headers[key]
+
+    def get_stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self.headers), 'max_size': self.size}
 
+
+header_cache = HeaderCache(500)
 blockchains = {}
 
 def read_blockchains(config):
@@ -129,7 +330,7 @@ def read_blockchains(config):
     return blockchains
 
 def check_header(header):
-    if type(header) is not dict:
+    if not isinstance(header, (dict, BlockHeader)):
         return False
     for b in blockchains.values():
         if b.check_header(header):
@@ -155,8 +356,18 @@ class Blockchain(util.PrintError):
         self.checkpoints = constants.net.CHECKPOINTS
         self.parent_id = parent_id
         self.lock = threading.Lock()
+        # read-only mapping of the headers file, see read_raw_header
+        self._mmap = None
+        # headers appended by save_header that are not written yet
+        self._buffer = bytearray()
+        self._buffer_time = 0
         with self.lock:
-            self.update_size(0)
+            self.trim_torn_tail()
+            self.update_size()
+        header_cache.invalidate(checkpoint)
+        # index records of this branch, from checkpoint on
+        self.index_lock = threading.RLock()
+        self.load_index()
 
     def parent(self):
         return blockchains[self.parent_id]
@@ -184,6 +395,7 @@ class Blockchain(util.PrintError):
         checkpoint = header.get('block_height')
         self = Blockchain(parent.config, checkpoint, parent.checkpoint)
         open(self.path(), 'w+').close()
+        header_cache.invalidate(checkpoint)
         self.save_header(header)
         return self
 
@@ -194,36 +406,43 @@ class Blockchain(util.PrintError):
         with self.lock:
             return self._size
 
-    def update_size(self, height):
+    def update_size(self):
         p = self.path()
         if os.path.exists(p):
             with open(p, 'rb') as f:
                 size = f.seek(0, 2)
-            self._size = self.calculate_size(height, size)
         else:
-            self._size = 0
+            size = 0
+        # length of the headers file, including buffered headers
+        self._bytes = size + len(self._buffer)
+        self._size = self.calculate_size(self.checkpoint, self._bytes)
+
+    def trim_torn_tail(self):
+        '''Cut off a partially written header at the end of the headers
+        file, left by a crash during a write.  Must hold self.lock'''
+        p = self.path()
+        if not os.path.exists(p):
+            return
+        with open(p, 'rb+') as f:
+            size = f.seek(0, 2)
+            n = self.calculate_size(self.checkpoint, size)
+            torn = size - self.get_offset(self.checkpoint, self.checkpoint + n)
+            if torn:
+                self.print_error("trimming %d bytes off torn header" % torn)
+                f.truncate(size - torn)
 
     def calculate_size(self, checkpoint, size_in_bytes):
-        size_before_fork = 0
-        size_after_fork = 0
-
-        if not is_post_equihash_fork(checkpoint):
-            size_before_fork = size_in_bytes//HDR_LEN
-            if is_post_equihash_fork(size_before_fork):
-                size_before_fork = BUBBLES_ACTIVATION_HEIGHT
-                checkpoint = BUBBLES_ACTIVATION_HEIGHT
-                size_in_bytes -= size_before_fork * HDR_LEN
-        else:
-            size_before_fork = BUBBLES_ACTIVATION_HEIGHT
-            size_in_bytes -= size_before_fork * HDR_LEN
-
-        if is_post_equihash_fork(checkpoint):
-            size_after_fork = size_in_bytes//HDR_EH_192_7_LEN
-
+        '''Number of whole headers in size_in_bytes of a file starting
+        at checkpoint'''
+        size_before_fork = max(0, BUBBLES_ACTIVATION_HEIGHT - checkpoint)
+        if size_in_bytes < size_before_fork * HDR_LEN:
+            return size_in_bytes//HDR_LEN
+        size_in_bytes -= size_before_fork * HDR_LEN
+        size_after_fork = size_in_bytes//HDR_EH_192_7_LEN
         return size_before_fork + size_after_fork
 
-    def verify_header(self, header, prev_hash, target):
-        _hash = hash_header(header)
+    def verify_header(self, header, prev_hash, target, header_hash=None):
+        _hash = header_hash or hash_header(header)
         if prev_hash != header.get('prev_block_hash'):
             raise Exception("prev hash mismatch: %s vs %s" % (prev_hash, header.get('prev_block_hash')))
         if constants.net.TESTNET:
@@ -251,29 +470,32 @@ class Blockchain(util.PrintError):
         if int('0x' + _hash, 16) > target:
             raise Exception("insufficient proof of work: %s vs target %s" % (int('0x' + _hash, 16), target))
 
-    def verify_chunk(self, height, data):
+    def verify_chunk(self, height, data, hashes=None):
+        if hashes is None:
+            hashes = hash_chunk(height, data)
         size = len(data)
         prev_hash = self.get_hash(height-1)
         chunk_headers = {'empty': True}
+        window = TargetWindow(self, height)
         offset = 0
         i = 0
         while offset < size:
             header_size = get_header_size(height)
             raw_header = data[offset:offset+header_size]
             header = deserialize_header(raw_header, height)
-            target = self.get_target(height, chunk_headers)
-            self.verify_header(header, prev_hash, target)
+            target = window.get_target(height, chunk_headers)
+            self.verify_header(header, prev_hash, target, hashes[i])
 
             chunk_headers[height] = header
             if i == 0:
                 chunk_headers['min_height'] = height
                 chunk_headers['empty'] = False
             chunk_headers['max_height'] = height
-            prev_hash = hash_header(header)
+            window.add_header(header)
+            prev_hash = hashes[i]
             offset += header_size
             height += 1
             i += 1
-            sleep(0.001)
 
     def path(self):
         d = util.get_headers_dir(self.config)
@@ -290,6 +512,7 @@ class Blockchain(util.PrintError):
         offset = self.get_offset(self.checkpoint, height)
         truncate = (height / CHUNK_LEN) >= len(self.checkpoints)
         self.write(chunk, offset, truncate)
+        self.extend_index(height, chunk)
         self.swap_with_parent()
 
     def swap_with_parent(self):
@@ -302,6 +525,10 @@ class Blockchain(util.PrintError):
         parent_id = self.parent_id
         checkpoint = self.checkpoint
         parent = self.parent()
+        my_index = bytes(self._index)
+        parent_index = bytes(parent._index)
+        self.flush()
+        parent.flush()
         with open(self.path(), 'rb') as f:
             my_data = f.read()
         offset = self.get_offset(parent.checkpoint, checkpoint)
@@ -313,71 +540,291 @@ class Blockchain(util.PrintError):
         # store file path
         for b in blockchains.values():
             b.old_path = b.path()
+            b.old_index_path = b.index_path()
+        # the mappings follow the files, not the branches
+        for b in [self, parent]:
+            with b.lock:
+                b.close_mmap()
+        header_cache.invalidate(self.checkpoint)
+        header_cache.invalidate(parent.checkpoint)
         # swap parameters
         self.parent_id = parent.parent_id; parent.parent_id = parent_id
         self.checkpoint = parent.checkpoint; parent.checkpoint = checkpoint
         self._size = parent._size; parent._size = parent_branch_size
+        self._bytes, parent._bytes = parent._bytes, self._bytes
+        # swap index records
+        with self.index_lock, parent.index_lock:
+            n = (checkpoint - self.checkpoint) * INDEX_RECORD_LEN
+            self._index = bytearray(parent_index[:n])
+            if len(self._index) == n:
+                self._index += my_index
+            parent._index = bytearray(parent_index[n:])
+            self.save_index()
+            parent.save_index()
         # move files
         for b in blockchains.values():
             if b in [self, parent]: continue
             if b.old_path != b.path():
                 self.print_error("renaming", b.old_path, b.path())
+                with b.lock:
+                    b.close_mmap()
                 os.rename(b.old_path, b.path())
+                if os.path.exists(b.old_index_path):
+                    os.rename(b.old_index_path, b.index_path())
         # update pointers
         blockchains[self.checkpoint] = self
         blockchains[parent.checkpoint] = parent
 
     def write(self, data, offset, truncate=True):
         filename = self.path()
-        current_offset = self.get_offset(self.checkpoint, self.size())
+        current_offset = self.get_offset(self.checkpoint, self.checkpoint + self.size())
 
         with self.lock:
+            self.flush_buffer()
             with open(filename, 'rb+') as f:
                 if truncate and offset != current_offset:
+                    # pages mapped past the new end of file must not be touched
+                    self.close_mmap()
                     f.seek(offset)
                     f.truncate()
+                    self._bytes = offset
                 f.seek(offset)
                 f.write(data)
                 f.flush()
                 os.fsync(f.fileno())
-        self.update_size(self.size())
+            self._bytes = max(self._bytes, offset + len(data))
+            self._size = self.calculate_size(self.checkpoint, self._bytes)
+        header_cache.invalidate(self.checkpoint)
+        self.truncate_index(self.height() + 1)
+
+    def append(self, data):
+        '''Buffer data at the end of the headers file.  The buffer is
+        written in one go by flush(), once it holds a chunk worth of
+        headers, or by the network thread when idle.'''
+        with self.lock:
+            if not self._buffer:
+                self._buffer_time = time.time()
+            self._buffer += data
+            self._bytes += len(data)
+            self._size = self.calculate_size(self.checkpoint, self._bytes)
+            if len(self._buffer) >= CHUNK_LEN * HDR_EH_192_7_LEN:
+                self.flush_buffer()
+
+    def flush_buffer(self):
+        '''Must hold self.lock'''
+        if not self._buffer:
+            return
+        with open(self.path(), 'rb+') as f:
+            f.seek(self._bytes - len(self._buffer))
+            f.write(self._buffer)
+            f.flush()
+            os.fsync(f.fileno())
+        self._buffer = bytearray()
+
+    def flush(self, idle=0):
+        '''Write buffered headers that are older than idle seconds, and
+        build some of the missing index records'''
+        with self.lock:
+            if self._buffer and time.time() - self._buffer_time >= idle:
+                self.flush_buffer()
+        self.fill_index()
 
     def save_header(self, header):
         height = header.get('block_height')
         delta = height - self.checkpoint
-        data = bfh(serialize_header(header))
+        data = header_to_bytes(header)
         offset = self.get_offset(self.checkpoint, height)
         header_size = get_header_size(height)
 
         assert delta == self.size()
         assert len(data) == header_size
-        self.write(data, offset)
+        if offset == self._bytes:
+            self.append(data)
+        else:
+            self.write(data, offset)
+        self.extend_index(height, data)
         self.swap_with_parent()
 
-    def read_header(self, height):
+    def close_mmap(self):
+        """Drop the mapping of the headers file; must hold self.lock"""
+        if self._mmap is None:
+            return
+        self._mmap.close()
+        self._mmap = None
+
+    def get_mmap(self, end):
+        """Return a read-only mapping of the headers file, remapping it
+        if the file has grown past the mapped length and `end` is not
+        covered yet.  Must hold self.lock"""
+        m = self._mmap
+        if m is not None and len(m) >= end:
+            return m
+        name = self.path()
+        if not os.path.exists(name):
+            if not os.path.exists(util.get_headers_dir(self.config)):
+                raise Exception('Electrum datadir does not exist. Was it deleted while running?')
+            raise Exception('Cannot find headers file but datadir is there. Should be at {}'.format(name))
+        self.close_mmap()
+        with open(name, 'rb') as f:
+            if f.seek(0, 2) == 0:
+                # empty files cannot be mapped
+                return b''
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def read_raw_header(self, height):
+        """Return the serialized header at height, or None if height is
+        not in this branch.  The header is copied out of the mapping
+        under the lock: no view of the map may outlive it, as write()
+        can truncate the file under the map."""
         assert self.parent_id != self.checkpoint
         if height < 0:
             return
         if height < self.checkpoint:
-            return self.parent().read_header(height)
+            return self.parent().read_raw_header(height)
         if height > self.height():
             return
         offset = self.get_offset(self.checkpoint, height)
         header_size = get_header_size(height)
-        name = self.path()
-        if os.path.exists(name):
-            with open(name, 'rb') as f:
+        with self.lock:
+            buffer_offset = self._bytes - len(self._buffer)
+            if offset >= buffer_offset:
+                # a copy, the buffer is resized on the next append
+                return bytes(self._buffer[offset-buffer_offset:offset-buffer_offset+header_size])
+            h = self.get_mmap(offset + header_size)[offset:offset+header_size]
+        if len(h) < header_size:
+            raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
+        return h
+
+    def read_header(self, height):
+        if 0 <= height < self.checkpoint:
+            # cached under the branch that has it
+            return self.parent().read_header(height)
+        header = header_cache.get(self.checkpoint, height)
+        if header is not None:
+            return header
+        h = self.read_raw_header(height)
+        if h is None:
+            return
+        if h == bytes(len(h)):
+            return None
+        header = deserialize_header(h, height)
+        header_cache.put(self.checkpoint, height, header)
+        return header
+
+    def index_path(self):
+        d = util.get_headers_dir(self.config)
+        filename = 'blockchain_headers_index' if self.parent_id is None else os.path.join('forks', 'index_%d_%d'%(self.parent_id, self.checkpoint))
+        return os.path.join(d, filename)
+
+    def load_index(self):
+        '''Load the index sidecar file.  Records past the end of the
+        branch, or a last record that does not match the headers file,
+        are dropped and rebuilt on demand.'''
+        with self.index_lock:
+            self._index = bytearray()
+            p = self.index_path()
+            if os.path.exists(p):
+                with open(p, 'rb') as f:
+                    self._index = bytearray(f.read())
+            n = min(len(self._index) // INDEX_RECORD_LEN, self.size())
+            if n:
+                raw = self.read_raw_header(self.checkpoint + n - 1)
+                if self._index[(n-1)*INDEX_RECORD_LEN:n*INDEX_RECORD_LEN] != index_record(raw):
+                    self.print_error("header index out of date, rebuilding", p)
+                    n = 0
+            if len(self._index) != n * INDEX_RECORD_LEN:
+                del self._index[n*INDEX_RECORD_LEN:]
+                self.save_index()
+
+    def save_index(self):
+        with self.index_lock:
+            with open(self.index_path(), 'wb') as f:
+                f.write(self._index)
+
+    def truncate_index(self, height):
+        '''Drop index records at height and above'''
+        with self.index_lock:
+            n = max(0, height - self.checkpoint) * INDEX_RECORD_LEN
+            if len(self._index) > n:
+                del self._index[n:]
+                with open(self.index_path(), 'rb+') as f:
+                    f.truncate(n)
+
+    def extend_index(self, height, data):
+        '''Write the index records of the serialized headers in data,
+        starting at height, over the records already there.  Records
+        after a gap are left to fill_index.'''
+        with self.index_lock:
+            offset = (height - self.checkpoint) * INDEX_RECORD_LEN
+            if offset > len(self._index):
+                return
+            data = memoryview(data)
+            records = bytearray()
+            i = 0
+            while i < len(data):
+                header_size = get_header_size(height)
+                records += index_record(data[i:i+header_size])
+                i += header_size
+                height += 1
+            self.write_index(offset, records)
+
+    def write_index(self, offset, records):
+        with self.index_lock:
+            self._index[offset:offset+len(records)] = records
+            with open(self.index_path(), 'rb+' if os.path.exists(self.index_path()) else 'wb') as f:
                 f.seek(offset)
-                h = f.read(header_size)
-                if len(h) < header_size:
-                    raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
-        elif not os.path.exists(util.get_headers_dir(self.config)):
-            raise Exception('Electrum datadir does not exist. Was it deleted while running?')
-        else:
-            raise Exception('Cannot find headers file but datadir is there. Should be at {}'.format(name))
-        if h == bytes([0])*header_size:
+                f.write(records)
+
+    def fill_index(self, count=None):
+        '''Build the next count (by default INDEX_FILL_LEN) missing index
+        records.  Returns the number of records built.'''
+        if count is None:
+            count = INDEX_FILL_LEN
+        with self.index_lock:
+            n = len(self._index) // INDEX_RECORD_LEN
+            end = min(self.checkpoint + n + count, self.height() + 1)
+            records = bytearray()
+            for h in range(self.checkpoint + n, end):
+                records += index_record(self.read_raw_header(h))
+            if records:
+                self.write_index(len(self._index), records)
+            return len(records) // INDEX_RECORD_LEN
+
+    def read_index(self, height):
+        '''Return the index record of the header at height, or None'''
+        if height < 0:
+            return
+        if height < self.checkpoint:
+            return self.parent().read_index(height)
+        if height > self.height():
+            return
+        with self.index_lock:
+            n = len(self._index) // INDEX_RECORD_LEN
+            if self.checkpoint + n <= height:
+                if height - self.checkpoint - n < INDEX_FILL_LEN:
+                    self.fill_index(height - self.checkpoint - n + 1)
+                else:
+                    # far past the records, until fill_index gets there
+                    r = index_record(self.read_raw_header(height))
+                    return r if r != bytes(INDEX_RECORD_LEN) else None
+            offset = (height - self.checkpoint) * INDEX_RECORD_LEN
+            r = bytes(self._index[offset:offset+INDEX_RECORD_LEN])
+        if r == bytes(INDEX_RECORD_LEN):
             return None
-        return deserialize_header(h, height)
+        return r
+
+    def get_timestamp(self, height):
+        r = self.read_index(height)
+        return INDEX_RECORD.unpack(r)[3] if r else None
+
+    def get_bits(self, height):
+        r = self.read_index(height)
+        return INDEX_RECORD.unpack(r)[4] if r else None
+
+    def get_merkle_root(self, height):
+        r = self.read_index(height)
+        return hash_encode(r[32:64]) if r else None
 
     def get_hash(self, height):
         if height == -1:
@@ -390,7 +837,8 @@ class Blockchain(util.PrintError):
             h, t, extra_headers = self.checkpoints[index]
             return h
         else:
-            return hash_header(self.read_header(height))
+            r = self.read_index(height)
+            return hash_encode(r[0:32]) if r else '0' * 64
 
     def get_median_time(self, height, chunk_headers=None):
         if chunk_headers is None or chunk_headers['empty']:
@@ -404,13 +852,13 @@ class Blockchain(util.PrintError):
                              max(1, height))
         median = []
         for h in height_range:
-            header = self.read_header(h)
-            if not header and not chunk_empty \
+            timestamp = self.get_timestamp(h)
+            if timestamp is None and not chunk_empty \
                 and min_height <= h <= max_height:
-                    header = chunk_headers[h]
-            if not header:
+                    timestamp = chunk_headers[h].get('timestamp')
+            if timestamp is None:
                 raise Exception("Can not read header at height %s" % h)
-            median.append(header.get('timestamp'))
+            median.append(timestamp)
 
         median.sort()
         return median[len(median)//2];
@@ -428,33 +876,19 @@ class Blockchain(util.PrintError):
 
         height_range = range(max(0, height - POW_AVERAGING_WINDOW),
                              max(1, height))
-        mean_target = 0
+        target_sum = 0
         for h in height_range:
-            header = self.read_header(h)
-            if not header and not chunk_empty \
+            bits = self.get_bits(h)
+            if bits is None and not chunk_empty \
                 and min_height <= h <= max_height:
-                    header = chunk_headers[h]
-            if not header:
+                    bits = chunk_headers[h].get('bits')
+            if bits is None:
                 raise Exception("Can not read header at height %s" % h)
-            mean_target += self.bits_to_target(header.get('bits'))
-        mean_target //= POW_AVERAGING_WINDOW
-
-        actual_timespan = self.get_median_time(height, chunk_headers) - \
-            self.get_median_time(height - POW_AVERAGING_WINDOW, chunk_headers)
-        actual_timespan = get_averaging_window_timespan(height) + \
-            int((actual_timespan - get_averaging_window_timespan(height)) / \
-                POW_DAMPING_FACTOR)
-        if actual_timespan < get_min_actual_timespan(height):
-            actual_timespan = get_min_actual_timespan(height)
-        elif actual_timespan > get_max_actual_timespan(height):
-            actual_timespan = get_max_actual_timespan(height)
+            target_sum += self.bits_to_target(bits)
 
-        next_target = mean_target // get_averaging_window_timespan(height) * actual_timespan
-
-        if next_target > MAX_TARGET:
-            next_target = MAX_TARGET
-
-        return next_target
+        return calculate_target(height, target_sum,
+                                self.get_median_time(height, chunk_headers),
+                                self.get_median_time(height - POW_AVERAGING_WINDOW, chunk_headers))
 
     def bits_to_target(self, bits):
         bitsN = (bits >> 24) & 0xff
@@ -496,12 +930,17 @@ class Blockchain(util.PrintError):
             self.verify_header(header, prev_hash, target)
         except BaseException as e:
             return False
+        if self.config.get('equihash') and not verify_equihash(header_to_bytes(header), height):
+            self.print_error("invalid equihash solution at height", height)
+            return False
         return True
 
-    def connect_chunk(self, idx, hexdata):
+    def connect_chunk(self, idx, hexdata, hashes=None):
+        '''hexdata may also be raw bytes; hashes are those returned by
+        hash_chunk, if already computed'''
         try:
-            data = bfh(hexdata)
-            self.verify_chunk(idx * CHUNK_LEN, data)
+            data = bfh(hexdata) if isinstance(hexdata, str) else hexdata
+            self.verify_chunk(idx * CHUNK_LEN, data, hashes)
             # self.print_error("validated chunk %d" % idx)
             self.save_chunk(idx * CHUNK_LEN, data)
             return True
@@ -509,6 +948,67 @@ class Blockchain(util.PrintError):
             self.print_error('verify_chunk %d failed'%idx, str(e))
             return False
 
+    def import_snapshot(self, path):
+        '''Append the headers of a snapshot file, laid out like
+        blockchain_headers, to this chain.  Chunks covered by checkpoints
+        are checked against their hash and extra headers only, later
+        chunks are verified like downloaded ones.  Stops at the first
+        chunk that fails; returns the number of chunks imported.'''
+        assert self.parent_id is None
+        index = (self.height() + 1) // CHUNK_LEN
+        count = 0
+        with open(path, 'rb') as f:
+            while True:
+                height = index * CHUNK_LEN
+                f.seek(self.get_offset(0, height))
+                data = f.read(self.get_offset(0, height + CHUNK_LEN) - self.get_offset(0, height))
+                # leave out a torn last header
+                n = size = 0
+                while n < CHUNK_LEN and size + get_header_size(height + n) <= len(data):
+                    size += get_header_size(height + n)
+                    n += 1
+                data = data[:size]
+                if height + n - 1 <= self.height():
+                    # nothing new
+                    break
+                try:
+                    hashes = hash_chunk(height, data)
+                    if height == 0 and hashes[0] != constants.net.GENESIS:
+                        raise Exception('genesis mismatch')
+                    if index < len(self.checkpoints):
+                        self.verify_checkpointed_chunk(index, data, hashes)
+                        self.save_chunk(height, data)
+                    elif not self.connect_chunk(index, data, hashes):
+                        raise Exception('invalid chunk')
+                except BaseException as e:
+                    self.print_error('snapshot chunk %d rejected:' % index, e)
+                    break
+                count += 1
+                index += 1
+                if len(hashes) < CHUNK_LEN:
+                    break
+        self.flush()
+        return count
+
+    def verify_checkpointed_chunk(self, index, data, hashes):
+        '''Checks that the headers of chunk index link up to its
+        checkpoint, without checking their targets'''
+        _hash, target, extra_headers = self.checkpoints[index]
+        if len(hashes) != CHUNK_LEN or hashes[-1] != _hash:
+            raise Exception('checkpoint mismatch')
+        height = index * CHUNK_LEN
+        prev_hash = self.get_hash(height - 1)
+        offset = 0
+        for i, h in enumerate(hashes):
+            if hash_encode(data[offset+4:offset+36]) != prev_hash:
+                raise Exception('prev hash mismatch at %d' % (height + i))
+            prev_hash = h
+            offset += get_header_size(height + i)
+        for h, header_data in extra_headers:
+            offset = self.get_offset(0, h) - self.get_offset(0, height)
+            if bh2u(data[offset:offset+get_header_size(h)]) != header_data:
+                raise Exception('extra header mismatch at %d' % h)
+
     def get_checkpoints(self):
         # for each chunk, store the hash of the last block and the target after the chunk
         cp = []
@@ -520,6 +1020,7 @@ class Blockchain(util.PrintError):
             if len(h.strip('0')) == 0:
                 raise Exception('%s file has not enough data.' % self.path())
             extra_headers = []
+            self.flush()
             if os.path.exists(self.path()):
                 with open(self.path(), 'rb') as f:
                     lower_header = height - TARGET_CALC_BLOCKS
@@ -535,16 +1036,86 @@ class Blockchain(util.PrintError):
         return cp
 
     def get_offset(self, checkpoint, height):
-        offset_before_fork = 0
-        offset_after_fork = 0
+        '''Offset of the header at height in a file starting at checkpoint'''
+        offset_before_fork = min(height, BUBBLES_ACTIVATION_HEIGHT) - min(checkpoint, BUBBLES_ACTIVATION_HEIGHT)
+        offset_after_fork = max(height, BUBBLES_ACTIVATION_HEIGHT) - max(checkpoint, BUBBLES_ACTIVATION_HEIGHT)
+        offset = (offset_before_fork * HDR_LEN) + (offset_after_fork * HDR_EH_192_7_LEN)
+        return offset
 
-        if not is_post_equihash_fork(height):
-            offset_before_fork = height - checkpoint
-        else:
-            offset_before_fork = BUBBLES_ACTIVATION_HEIGHT
 
-        if is_post_equihash_fork(height):
-            offset_after_fork = height - max(checkpoint, BUBBLES_ACTIVATION_HEIGHT)
+class TargetWindow(object):
+    """
+    Running state of Blockchain.get_target() over consecutive heights.
 
-        offset = (offset_before_fork * HDR_LEN) + (offset_after_fork * HDR_EH_192_7_LEN)
-        return offset
+    Keeps the bits and timestamps of the last TARGET_CALC_BLOCKS + 1
+    headers, the sum of the averaged targets and both median time spans
+    sorted, so that each further height is a constant amount of work
+    instead of re-reading the whole window.  Headers found in the branch
+    take precedence over those passed to add_header(), like in get_target.
+    """
+
+    def __init__(self, blockchain, height):
+        self.blockchain = blockchain
+        self.bits = {}
+        self.timestamps = {}
+        self.targets = {}
+        self.next_height = height
+        self.target_sum = None
+        # sorted timestamps of the median time spans ending at the
+        # next height and POW_AVERAGING_WINDOW blocks earlier
+        self.recent = []
+        self.past = []
+        for h in range(max(0, height - TARGET_CALC_BLOCKS - 1), height):
+            self.bits[h] = blockchain.get_bits(h)
+            self.timestamps[h] = blockchain.get_timestamp(h)
+
+    def add_header(self, header):
+        h = header.get('block_height')
+        assert h == self.next_height, (h, self.next_height)
+        bits = self.blockchain.get_bits(h)
+        timestamp = self.blockchain.get_timestamp(h)
+        self.bits[h] = header.get('bits') if bits is None else bits
+        self.timestamps[h] = header.get('timestamp') if timestamp is None else timestamp
+        self.next_height = h + 1
+
+    def get_timestamp(self, h):
+        t = self.timestamps.get(h)
+        if t is None:
+            raise Exception("Can not read header at height %s" % h)
+        return t
+
+    def get_window_target(self, h):
+        bits = self.bits.get(h)
+        if bits is None:
+            raise Exception("Can not read header at height %s" % h)
+        target = self.blockchain.bits_to_target(bits)
+        self.targets[h] = target
+        return target
+
+    def get_target(self, height, chunk_headers=None):
+        assert height == self.next_height, (height, self.next_height)
+        if height <= TARGET_CALC_BLOCKS:
+            # median time spans are clamped at genesis
+            return self.blockchain.get_target(height, chunk_headers)
+        if self.target_sum is None:
+            self.target_sum = sum(self.get_window_target(h)
+                                  for h in range(height - POW_AVERAGING_WINDOW, height))
+            self.recent = sorted(self.get_timestamp(h)
+                                 for h in range(height - POW_MEDIAN_BLOCK_SPAN, height))
+            self.past = sorted(self.get_timestamp(h)
+                               for h in range(height - TARGET_CALC_BLOCKS, height - POW_AVERAGING_WINDOW))
+        elif height - 1 not in self.targets:
+            # slide every window by one header
+            self.target_sum += self.get_window_target(height - 1)
+            self.target_sum -= self.targets.pop(height - 1 - POW_AVERAGING_WINDOW)
+            self.slide(self.recent, height - 1, height - 1 - POW_MEDIAN_BLOCK_SPAN)
+            self.slide(self.past, height - 1 - POW_AVERAGING_WINDOW, height - 1 - TARGET_CALC_BLOCKS)
+            self.bits.pop(height - 2 - TARGET_CALC_BLOCKS, None)
+            self.timestamps.pop(height - 2 - TARGET_CALC_BLOCKS, None)
+        return calculate_target(height, self.target_sum,
+                                self.recent[len(self.recent)//2],
+                                self.past[len(self.past)//2])
+
+    def slide(self, window, new_height, old_height):
+        del window[bisect_left(window, self.get_timestamp(old_height))]
+        insort(window, self.get_timestamp(new_height))
@@ -30,6 +30,7 @@ import argparse
 import json
 import ast
 import base64
+import itertools
 from functools import wraps
 from decimal import Decimal
 
@@ -338,6 +339,12 @@ class Commands:
         """Return the list of available servers"""
         return self.network.get_servers()
 
+    @command('n')
+    def getnetworkstats(self):
+        """Return request counts and latencies per method, traffic and
+        queue depths per server, and time spent in the network loop."""
+        return self.network.get_network_stats()
+
     @command('')
     def version(self):
         """Return the version of Electrum-Zclassic."""
@@ -443,8 +450,10 @@ class Commands:
         return tx.as_dict()
 
     @command('w')
-    def history(self, year=None, show_addresses=False, show_fiat=False):
-        """Wallet history. Returns the transaction history of your wallet."""
+    def history(self, year=None, show_addresses=False, show_fiat=False, limit=None, cursor=None):
+        """Wallet history. Returns the transaction history of your wallet.
+        With a limit or a cursor, returns a page of transactions, newest
+        first, and the cursor of the next page."""
         kwargs = {'show_addresses': show_addresses}
         if year:
             import time
@@ -456,6 +465,13 @@ class Commands:
             from .exchange_rate import FxThread
             fx = FxThread(self.config, None)
             kwargs['fx'] = fx
+        if limit is not None or cursor is not None:
+            rows = self.wallet.iter_history(kwargs.get('from_timestamp'), kwargs.get('to_timestamp'), cursor)
+            # value may be None if wallet is not fully synchronized
+            rows = itertools.islice((row for row in rows if row[4] is not None), limit)
+            out = [self.wallet.get_history_item(row, kwargs.get('fx'), show_addresses) for row in rows]
+            next_cursor = out[-1]['txid'] if out and len(out) == limit else None
+            return json_encode({'transactions': out, 'cursor': next_cursor})
         return json_encode(self.wallet.get_full_history(**kwargs))
 
     @command('w')
@@ -723,6 +739,8 @@ command_options = {
     'show_addresses': (None, "Show input and output addresses"),
     'show_fiat':   (None, "Show fiat value of transactions"),
     'year':        (None, "Show history for a given year"),
+    'limit':       (None, "Maximum number of transactions"),
+    'cursor':      (None, "Show the transactions that precede this one (cursor returned with the previous page)"),
 }
 
 
@@ -734,6 +752,7 @@ arg_types = {
     'nbits': int,
     'imax': int,
     'year': int,
+    'limit': int,
     'tx': tx_from_str,
     'pubkeys': json_loads,
     'jsontx': json_loads,
@@ -813,6 +832,7 @@ def add_network_options(parser):
     parser.add_argument("-1", "--oneserver", action="store_true", dest="oneserver", default=None, help="connect to one server only")
     parser.add_argument("-s", "--server", dest="server", default=None, help="set server host:port:protocol, where protocol is either t (tcp) or s (ssl)")
     parser.add_argument("-p", "--proxy", dest="proxy", default=None, help="set proxy [type:]host[:port], where type is socks4,socks5 or http")
+    parser.add_argument("--headers-snapshot", dest="headers_snapshot", default=None, help="import block headers from a snapshot file, verified against the checkpoints")
 
 def add_global_options(parser):
     group = parser.add_argument_group('global options')
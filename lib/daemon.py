@@ -41,6 +41,7 @@ from .storage import WalletStorage
 from .commands import known_commands, Commands
 from .simple_config import SimpleConfig
 from .exchange_rate import FxThread
+from .network_stats import MetricsServer
 
 
 def get_lockfile(config):
@@ -133,6 +134,21 @@ class Daemon(DaemonThread):
         self.wallets = {}
         # Setup JSONRPC server
         self.init_server(config, fd, is_gui)
+        self.init_metrics_server(config)
+
+    def init_metrics_server(self, config):
+        '''Serve network stats to Prometheus if metrics_port is set'''
+        self.metrics_server = None
+        port = config.get('metrics_port')
+        if not self.network or not port:
+            return
+        host = config.get('metrics_host', '127.0.0.1')
+        try:
+            self.metrics_server = MetricsServer(self.network, host, int(port))
+        except Exception as e:
+            self.print_error('Warning: cannot initialize metrics server on host', host, e)
+            return
+        self.metrics_server.start()
 
     def init_server(self, config, fd, is_gui):
         host = config.get('rpchost', '127.0.0.1')
@@ -290,6 +306,8 @@ class Daemon(DaemonThread):
             self.server.handle_request() if self.server else time.sleep(0.1)
         for k, wallet in self.wallets.items():
             wallet.stop_threads()
+        if self.metrics_server:
+            self.metrics_server.stop()
         if self.network:
             self.print_error("shutting down network")
             self.network.stop()
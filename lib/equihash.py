@@ -0,0 +1,129 @@
+# Electrum - Lightweight ZClassic Client
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+'''Equihash proof of work verification.
+
+The 2^k leaf hashes of a solution are kept as n-bit integers, and each
+round of the tree is reduced with a single pass over the whole level, so
+the work per header is 2^k blake2b digests and 2^k - 1 integer XORs.'''
+
+import struct
+
+try:
+    from hashlib import blake2b
+except ImportError:
+    # python < 3.6
+    from pyblake2 import blake2b
+
+
+EQUIHASH_HEADER_LEN = 140   # version .. nonce, the input of the PoW
+
+
+def solution_size(n, k):
+    return (1 << k) * (n // (k + 1) + 1) // 8
+
+
+def read_compact_size(s, offset):
+    '''Returns (value, offset after it)'''
+    b = s[offset]
+    if b < 0xfd:
+        return b, offset + 1
+    if b == 0xfd:
+        return struct.unpack_from('<H', s, offset + 1)[0], offset + 3
+    if b == 0xfe:
+        return struct.unpack_from('<I', s, offset + 1)[0], offset + 5
+    return struct.unpack_from('<Q', s, offset + 1)[0], offset + 9
+
+
+def get_indices(n, k, solution):
+    '''The 2^k indices packed big endian in solution, with
+    n/(k+1)+1 bits each'''
+    bits = n // (k + 1) + 1
+    s = format(int.from_bytes(solution, 'big'), '0%db' % (len(solution) * 8))
+    return [int(s[i:i+bits], 2) for i in range(0, len(s), bits)]
+
+
+class Equihash(object):
+
+    def __init__(self, n, k, person=b'ZcashPoW'):
+        if n % 8 or n % (k + 1):
+            raise Exception('Unsupported equihash parameters {},{}'.format(n, k))
+        self.n = n
+        self.k = k
+        self.person = person + struct.pack('<II', n, k)
+        self.collision_bits = n // (k + 1)
+        self.indices_per_hash = 512 // n
+        self.solution_size = solution_size(n, k)
+
+    def leaf_hashes(self, header, indices):
+        '''The n-bit hash of every index, for header[:140]'''
+        state = blake2b(digest_size=self.indices_per_hash * self.n // 8,
+                        person=self.person)
+        state.update(header[:EQUIHASH_HEADER_LEN])
+        n_bytes = self.n // 8
+        digests = {}
+        leaves = []
+        for i in indices:
+            j, r = divmod(i, self.indices_per_hash)
+            digest = digests.get(j)
+            if digest is None:
+                h = state.copy()
+                h.update(struct.pack('<I', j))
+                digest = digests[j] = h.digest()
+            leaves.append(int.from_bytes(digest[r*n_bytes:(r+1)*n_bytes], 'big'))
+        return leaves
+
+    def is_valid_solution(self, header, solution):
+        if len(solution) != self.solution_size:
+            return False
+        indices = get_indices(self.n, self.k, solution)
+        if len(set(indices)) != len(indices):
+            return False
+        hashes = self.leaf_hashes(header, indices)
+        firsts = indices
+        for r in range(1, self.k + 1):
+            shift = self.n - r * self.collision_bits
+            # sibling subtrees must collide on the next collision_bits and
+            # be ordered by their first index
+            hashes = [a ^ b for a, b in zip(hashes[::2], hashes[1::2])]
+            if any(h >> shift for h in hashes):
+                return False
+            if any(a >= b for a, b in zip(firsts[::2], firsts[1::2])):
+                return False
+            firsts = firsts[::2]
+        return hashes[0] == 0
+
+    def verify_header(self, header):
+        '''Checks the solution of a serialized header'''
+        size, offset = read_compact_size(header, EQUIHASH_HEADER_LEN)
+        solution = header[offset:]
+        if size != len(solution):
+            return False
+        return self.is_valid_solution(header, solution)
+
+
+_instances = {}
+
+def get_equihash(n, k):
+    e = _instances.get((n, k))
+    if e is None:
+        e = _instances[(n, k)] = Equihash(n, k)
+    return e
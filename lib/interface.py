@@ -41,6 +41,77 @@ from . import util
 from . import x509
 from . import pem
 
+# Session resumption needs Python 3.6
+HAS_TLS_SESSIONS = hasattr(ssl.SSLSocket, 'session')
+
+
+class TLSSessionCache(object):
+    """SSL contexts and the last TLS session of each server, so that
+    reconnections resume the session instead of doing a full handshake.
+    A session can only be resumed with the context that created it, so
+    contexts are kept as well, and replaced when the certificates they
+    were created from change on disk.  Without session support the
+    cache only keeps contexts."""
+
+    def __init__(self, enabled=HAS_TLS_SESSIONS):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        # server -> (ca_certs, mtime, context)
+        self.contexts = {}
+        # server -> ssl.SSLSession
+        self.sessions = {}
+        self.resumed = 0
+
+    def get_context(self, server, ca_certs, create):
+        try:
+            mtime = os.path.getmtime(ca_certs)
+        except (OSError, TypeError):
+            mtime = None
+        with self.lock:
+            item = self.contexts.get(server)
+            if item and item[:2] == (ca_certs, mtime):
+                return item[2]
+            context = create()
+            self.contexts[server] = (ca_certs, mtime, context)
+            self.sessions.pop(server, None)
+            return context
+
+    def get_session(self, server):
+        if not self.enabled:
+            return None
+        with self.lock:
+            return self.sessions.get(server)
+
+    def save(self, server, s):
+        '''Remember the session of socket s.  With TLS 1.3 the session
+        ticket arrives after the handshake, so this is also called when
+        the socket gets closed.'''
+        if not self.enabled:
+            return
+        session = getattr(s, 'session', None)
+        if session is None:
+            return
+        with self.lock:
+            item = self.contexts.get(server)
+            if item and s.context is item[2]:
+                self.sessions[server] = session
+
+    def on_resumed(self):
+        with self.lock:
+            self.resumed += 1
+
+    def remove(self, server):
+        with self.lock:
+            self.contexts.pop(server, None)
+            self.sessions.pop(server, None)
+
+    def get_stats(self):
+        with self.lock:
+            return {'sessions': len(self.sessions), 'resumed': self.resumed}
+
+
+tls_sessions = TLSSessionCache()
+
 
 def Connection(server, queue, config_path):
     """Makes asynchronous connections to a remote Electrum server.
@@ -131,6 +202,21 @@ class TcpConnection(threading.Thread, util.PrintError):
 
         return context
 
+    def wrap_socket(self, s, cert_reqs, ca_certs):
+        '''Handshake using the cached context of the server, resuming its
+        last TLS session if there is one.'''
+        context = tls_sessions.get_context(self.server, ca_certs,
+                                           lambda: self.get_ssl_context(cert_reqs, ca_certs))
+        if not HAS_TLS_SESSIONS:
+            return context.wrap_socket(s, do_handshake_on_connect=True)
+        session = tls_sessions.get_session(self.server)
+        s = context.wrap_socket(s, do_handshake_on_connect=True, session=session)
+        if s.session_reused:
+            self.print_error("resumed TLS session")
+            tls_sessions.on_resumed()
+        tls_sessions.save(self.server, s)
+        return s
+
     def get_socket(self):
         if self.use_ssl:
             cert_path = os.path.join(self.config_path, 'certs', self.host)
@@ -141,8 +227,7 @@ class TcpConnection(threading.Thread, util.PrintError):
                     return
                 # try with CA first
                 try:
-                    context = self.get_ssl_context(cert_reqs=ssl.CERT_REQUIRED, ca_certs=ca_path)
-                    s = context.wrap_socket(s, do_handshake_on_connect=True)
+                    s = self.wrap_socket(s, ssl.CERT_REQUIRED, ca_path)
                 except ssl.SSLError as e:
                     self.print_error(e)
                     s = None
@@ -152,6 +237,7 @@ class TcpConnection(threading.Thread, util.PrintError):
                 if s and self.check_host_name(s.getpeercert(), self.host):
                     self.print_error("SSL certificate signed by CA")
                     return s
+                tls_sessions.remove(self.server)
                 # get server certificate.
                 # Do not use ssl.get_server_certificate because it does not work with proxy
                 s = self.get_simple_socket()
@@ -185,14 +271,17 @@ class TcpConnection(threading.Thread, util.PrintError):
 
         if self.use_ssl:
             try:
-                context = self.get_ssl_context(cert_reqs=ssl.CERT_REQUIRED,
-                                               ca_certs=(temporary_path if is_new else cert_path))
-                s = context.wrap_socket(s, do_handshake_on_connect=True)
+                if is_new:
+                    context = self.get_ssl_context(cert_reqs=ssl.CERT_REQUIRED, ca_certs=temporary_path)
+                    s = context.wrap_socket(s, do_handshake_on_connect=True)
+                else:
+                    s = self.wrap_socket(s, ssl.CERT_REQUIRED, cert_path)
             except socket.timeout:
                 self.print_error('timeout')
                 return
             except ssl.SSLError as e:
                 self.print_error("SSL error:", e)
+                tls_sessions.remove(self.server)
                 if e.errno != 1:
                     return
                 if is_new:
@@ -242,11 +331,20 @@ class Interface(util.PrintError):
     """The Interface class handles a socket connected to a single remote
     Electrum server.  Its exposed API is:
 
-    - Member functions close(), fileno(), get_responses(), has_timed_out(),
-      ping_required(), queue_request(), send_requests()
+    - Member functions close(), fileno(), get_responses(), get_stats(),
+      has_timed_out(), ping_required(), queue_request(), send_requests()
     - Member variable server.
+
+    The number of unanswered requests is limited by a window that grows
+    while response times stay close to the lowest seen for the same
+    method, and is halved when they go up (AIMD).
     """
 
+    MIN_WINDOW = 2
+    MAX_WINDOW = 250
+    MIN_TIMEOUT = 10
+    MAX_TIMEOUT = 60
+
     def __init__(self, server, socket):
         self.server = server
         self.host, _, _ = server.rsplit(':', 2)
@@ -258,6 +356,29 @@ class Interface(util.PrintError):
         self.debug = False
         self.unsent_requests = []
         self.unanswered_requests = {}
+        # requests per JSON-RPC batch; 1 disables batching
+        self.batch_size = 50
+        # wire ids of each batch that has not had any answer yet, in
+        # the order they were sent
+        self.unanswered_batches = []
+        # wire id -> send time
+        self.send_times = {}
+        self.window = 10.
+        self.slow_start = True
+        self.last_decrease = 0
+        # smoothed round trip time, its mean deviation, and the lowest seen
+        self.srtt = None
+        self.rttvar = 0
+        self.min_rtt = None
+        # method -> lowest round trip time seen.  Queueing is detected
+        # against the baseline of the same method, as a header chunk
+        # takes longer than a ping without any queueing
+        self.min_rtts = {}
+        self.responses_per_second = 0.
+        self.rate_count = 0
+        # called with the method and round trip time of each request
+        self.on_request_time = None
+        self.rate_time = time.time()
         # Set last ping to zero to ensure immediate ping
         self.last_request = time.time()
         self.last_ping = 0
@@ -271,6 +392,7 @@ class Interface(util.PrintError):
         return self.socket.fileno()
 
     def close(self):
+        tls_sessions.save(self.server, self.socket)
         if not self.closed_remotely:
             try:
                 self.socket.shutdown(socket.SHUT_RDWR)
@@ -286,27 +408,99 @@ class Interface(util.PrintError):
         self.unsent_requests.append(args)
 
     def num_requests(self):
-        '''Keep unanswered requests below 100'''
-        n = 100 - len(self.unanswered_requests)
-        return min(n, len(self.unsent_requests))
+        '''Keep unanswered requests below the window'''
+        n = int(self.window) - len(self.unanswered_requests)
+        return max(0, min(n, len(self.unsent_requests)))
+
+    def on_response_time(self, rtt, method=None):
+        now = time.time()
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+            self.min_rtt = rtt
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+            self.min_rtt = min(self.min_rtt, rtt)
+        min_rtt = min(self.min_rtts.get(method, rtt), rtt)
+        self.min_rtts[method] = min_rtt
+        if rtt > 2 * min_rtt + 0.1:
+            # queueing: back off, at most once per round trip
+            if now - self.last_decrease > self.srtt:
+                self.window = max(self.MIN_WINDOW, self.window / 2)
+                self.slow_start = False
+                self.last_decrease = now
+        elif self.slow_start:
+            self.window = min(self.MAX_WINDOW, self.window + 1)
+        else:
+            self.window = min(self.MAX_WINDOW, self.window + 1 / self.window)
+        self.rate_count += 1
+        if now - self.rate_time >= 1:
+            rate = self.rate_count / (now - self.rate_time)
+            self.responses_per_second = 0.7 * self.responses_per_second + 0.3 * rate
+            self.rate_count = 0
+            self.rate_time = now
+
+    def request_timeout(self):
+        if self.srtt is None:
+            return self.MIN_TIMEOUT
+        return min(self.MAX_TIMEOUT, max(self.MIN_TIMEOUT, 4 * (self.srtt + 4 * self.rttvar)))
+
+    def get_stats(self):
+        return {
+            'rtt': self.srtt,
+            'min_rtt': self.min_rtt,
+            'window': int(self.window),
+            'unanswered': len(self.unanswered_requests),
+            'responses_per_second': self.responses_per_second,
+            'timeout': self.request_timeout(),
+            'unsent': len(self.unsent_requests),
+            'bytes_sent': self.pipe.bytes_sent,
+            'bytes_received': self.pipe.bytes_received,
+        }
 
     def send_requests(self):
         '''Sends queued requests.  Returns False on failure.'''
         make_dict = lambda m, p, i: {'method': m, 'params': p, 'id': i}
+        # batches are a JSON-RPC 2.0 feature
+        make_batch_dict = lambda m, p, i: {'jsonrpc': '2.0', 'method': m, 'params': p, 'id': i}
         n = self.num_requests()
         wire_requests = self.unsent_requests[0:n]
+        messages = []
+        for i in range(0, len(wire_requests), self.batch_size):
+            requests = wire_requests[i:i+self.batch_size]
+            if len(requests) > 1:
+                messages.append([make_batch_dict(*r) for r in requests])
+            else:
+                messages.append(make_dict(*requests[0]))
         try:
-            self.pipe.send_all([make_dict(*r) for r in wire_requests])
+            self.pipe.send_all(messages)
         except BaseException as e:
             self.print_error("pipe send error:", e)
             return False
         self.unsent_requests = self.unsent_requests[n:]
+        now = time.time()
         for request in wire_requests:
             if self.debug:
                 self.print_error("-->", request)
             self.unanswered_requests[request[2]] = request
+            self.send_times[request[2]] = now
+        self.unanswered_batches.extend(set(m['id'] for m in batch)
+                                       for batch in messages if type(batch) is list)
         return True
 
+    def on_batch_rejected(self, batch_ids):
+        '''Resend the requests of a rejected batch one per line, and stop
+        batching'''
+        if self.batch_size > 1:
+            self.print_error("batch requests rejected, sending them one by one")
+        self.batch_size = 1
+        requests = [self.unanswered_requests.pop(i) for i in sorted(batch_ids)
+                    if i in self.unanswered_requests]
+        for request in requests:
+            self.send_times.pop(request[2], None)
+        self.unsent_requests = requests + self.unsent_requests
+
     def ping_required(self):
         '''Maintains time since last ping.  Returns True if a ping should
         be sent.
@@ -319,8 +513,9 @@ class Interface(util.PrintError):
 
     def has_timed_out(self):
         '''Returns True if the interface has timed out.'''
-        if (self.unanswered_requests and time.time() - self.request_time > 10
-            and self.pipe.idle_time() > 10):
+        timeout = self.request_timeout()
+        if (self.unanswered_requests and time.time() - self.request_time > timeout
+            and self.pipe.idle_time() > timeout):
             self.print_error("timeout", len(self.unanswered_requests))
             return True
 
@@ -341,25 +536,48 @@ class Interface(util.PrintError):
                 response = self.pipe.get()
             except util.timeout:
                 break
-            if not type(response) is dict:
+            # the responses to a batch come in an array
+            batch = response if type(response) is list and response else [response]
+            if not all(type(r) is dict for r in batch):
                 responses.append((None, None))
                 if response is None:
                     self.closed_remotely = True
                     self.print_error("connection closed remotely")
                 break
-            if self.debug:
-                self.print_error("<--", response)
-            wire_id = response.get('id', None)
-            if wire_id is None:  # Notification
-                responses.append((None, response))
-            else:
-                request = self.unanswered_requests.pop(wire_id, None)
-                if request:
-                    responses.append((request, response))
+            for response in batch:
+                if self.debug:
+                    self.print_error("<--", response)
+                wire_id = response.get('id', None)
+                if wire_id is None and 'error' in response and 'method' not in response:
+                    # a server without batch support rejects a batch
+                    # as a whole.  Only a batch none of whose requests
+                    # were answered can have been rejected; the error
+                    # belongs to the oldest one
+                    if self.unanswered_batches:
+                        self.on_batch_rejected(self.unanswered_batches.pop(0))
+                    else:
+                        responses.append((None, response))
+                    continue
+                if wire_id is None:  # Notification
+                    responses.append((None, response))
                 else:
-                    self.print_error("unknown wire ID", wire_id)
-                    responses.append((None, None)) # Signal
-                    break
+                    if self.unanswered_batches:
+                        # an answered batch was accepted
+                        self.unanswered_batches = [b for b in self.unanswered_batches
+                                                   if wire_id not in b]
+                    send_time = self.send_times.pop(wire_id, None)
+                    rtt = None if send_time is None else time.time() - send_time
+                    request = self.unanswered_requests.pop(wire_id, None)
+                    if rtt is not None:
+                        self.on_response_time(rtt, request[0] if request else None)
+                    if request and rtt is not None and self.on_request_time:
+                        self.on_request_time(request[0], rtt)
+                    if request:
+                        responses.append((request, response))
+                    else:
+                        self.print_error("unknown wire ID", wire_id)
+                        responses.append((None, None)) # Signal
+                        return responses
 
         return responses
 
@@ -30,6 +30,9 @@ import re
 import select
 from collections import defaultdict
 import threading
+import multiprocessing
+import multiprocessing.pool
+import functools
 import socket
 import json
 
@@ -37,9 +40,13 @@ import socks
 from . import util
 from . import bitcoin
 from .bitcoin import *
-from .blockchain import CHUNK_LEN, get_header_size
+from .blockchain import CHUNK_LEN, get_header_size, hash_chunk
 from . import constants
-from .interface import Connection, Interface
+from .interface import Connection, Interface, tls_sessions
+from .server_scores import ServerScores
+from .response_cache import ResponseCache, CACHED_METHODS
+from .subscriptions import SubscriptionRegistry
+from .network_stats import NetworkStats
 from . import blockchain
 from .version import ELECTRUM_VERSION, PROTOCOL_VERSION
 from .i18n import _
@@ -47,6 +54,27 @@ from .i18n import _
 
 NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
+SCORES_INTERVAL = 60
+# read-only requests that can be answered by any server, see route_request
+ROUTED_METHODS = {
+    'blockchain.transaction.get',
+    'blockchain.transaction.get_merkle',
+    'blockchain.scripthash.get_history',
+}
+# how much better another server must score to switch to it, in how
+# many consecutive score updates, and how long we stay on a server
+# before that.  Switching resends all subscriptions
+SWITCH_SCORE_RATIO = 0.7
+SWITCH_ROUNDS = 3
+MIN_SERVER_TIME = 600
+# server.ping round trips are what servers are scored by: they are
+# comparable between servers, unlike the requests we send to ours
+SCORE_PING_INTERVAL = 15
+CHUNK_REQUEST_TIMEOUT = 20
+# seconds a handshaked standby connection is kept before it is renewed
+WARM_SOCKET_MAX_AGE = 300
+# longest wait in select(); other threads interrupt it with Network.wakeup
+SELECT_TIMEOUT = 1
 
 
 def parse_servers(result):
@@ -151,6 +179,18 @@ def serialize_server(host, port, protocol):
     return str(':'.join([host, port, protocol]))
 
 
+class SocketQueue(queue.Queue):
+    '''Queue of connected sockets that wakes up the network thread'''
+
+    def __init__(self, wakeup):
+        queue.Queue.__init__(self)
+        self.wakeup = wakeup
+
+    def put(self, item, block=True, timeout=None):
+        queue.Queue.put(self, item, block, timeout)
+        self.wakeup()
+
+
 class Network(util.DaemonThread):
     """The Network class manages a set of connections to remote electrum
     servers, each connected socket is handled by an Interface() object.
@@ -159,7 +199,8 @@ class Network(util.DaemonThread):
 
     Our external API:
 
-    - Member functions get_header(), get_interfaces(), get_local_height(),
+    - Member functions get_header(), get_interfaces(),
+          get_interface_stats(), get_local_height(),
           get_parameters(), get_server_height(), get_status_value(),
           is_connected(), set_parameters(), stop()
     """
@@ -168,6 +209,10 @@ class Network(util.DaemonThread):
         if config is None:
             config = {}  # Do not use mutables as default values!
         util.DaemonThread.__init__(self)
+        # written to by other threads to interrupt select() in wait_on_sockets
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
         self.config = SimpleConfig(config) if isinstance(config, dict) else config
         self.num_server = 10 if not self.config.get('oneserver') else 0
         self.blockchains = blockchain.read_blockchains(self.config)
@@ -192,13 +237,28 @@ class Network(util.DaemonThread):
         self.debug = False
         self.irc_servers = {} # returned by interface (list from irc)
         self.recent_servers = self.read_recent_servers()
+        self.server_scores = ServerScores(self.config.path)
+        self.stats = NetworkStats()
+        self.scores_time = time.time()
+        self.score_ping_time = 0
+        # when we switched to the current interface
+        self.interface_time = time.time()
+        # (server, number of score updates it scored clearly better than ours)
+        self.switch_candidate = None, 0
 
         self.banner = ''
         self.donation_address = ''
         self.relay_fee = None
         # callbacks passed with subscriptions
-        self.subscriptions = defaultdict(list)
+        self.subscriptions = SubscriptionRegistry()
+        # last response of each subscription.  Address subscriptions are
+        # dropped, with their h2addr entry, once nobody is subscribed
         self.sub_cache = {}
+        # responses that cannot change, shared by all interfaces
+        self.response_cache = ResponseCache(self.config.get('response_cache_size', 1000),
+                                            self.config.path if self.config.get('persist_response_cache') else None)
+        # (height, hash) of the tip of our chain, see check_reorg
+        self.main_tip = None
         # callbacks set by the GUI
         self.callbacks = defaultdict(list)
 
@@ -212,6 +272,9 @@ class Network(util.DaemonThread):
         self.h2addr = {}
         # Requests from client we've not seen a response to
         self.unanswered_requests = {}
+        # message id -> (server, send time) of client requests that
+        # were routed to other interfaces than the main one
+        self.routed_requests = {}
         # retry times
         self.server_retry_time = time.time()
         self.nodes_retry_time = time.time()
@@ -222,8 +285,21 @@ class Network(util.DaemonThread):
         self.interfaces = {}
         self.auto_connect = self.config.get('auto_connect', True)
         self.connecting = set()
-        self.requested_chunks = set()
-        self.socket_queue = queue.Queue()
+        # standby connections, handshaked ahead of time so that they can
+        # replace an interface that went down without waiting for a new
+        # connection.  warming is the set of servers being connected to
+        # for the pool, warm_sockets maps server -> (socket, connect time)
+        self.num_warm = self.config.get('warm_connections', 2) if not self.config.get('oneserver') else 0
+        self.warming = set()
+        self.warm_sockets = {}
+        # chunk index -> (interface, blockchain, request time)
+        self.requested_chunks = {}
+        # chunks hashed, or being checked by the worker pool, keyed by index
+        self.verifying_chunks = {}
+        self.chunk_pool = None
+        # (process pool, probe result, start time) until the workers answer
+        self.chunk_workers = None
+        self.socket_queue = SocketQueue(self.wakeup)
         self.start_network(deserialize_server(self.default_server)[2],
                            deserialize_proxy(self.config.get('proxy')))
 
@@ -301,15 +377,19 @@ class Network(util.DaemonThread):
         self.message_id += 1
         if self.debug:
             self.print_error(interface.host, "-->", method, params, message_id)
+        self.stats.add_request(method)
         interface.queue_request(method, params, message_id)
         return message_id
 
     def send_subscriptions(self):
         self.print_error('sending subscriptions to', self.interface.server, len(self.unanswered_requests), len(self.subscribed_addresses))
-        self.sub_cache.clear()
+        with self.lock:
+            self.sub_cache.clear()
+            subscribed_addresses = list(self.subscribed_addresses)
         # Resend unanswered requests
         requests = self.unanswered_requests.values()
         self.unanswered_requests = {}
+        self.routed_requests = {}
         if self.interface.ping_required():
             params = [ELECTRUM_VERSION, PROTOCOL_VERSION]
             self.queue_request('server.version', params, self.interface)
@@ -321,7 +401,7 @@ class Network(util.DaemonThread):
         self.queue_request('server.peers.subscribe', [])
         self.request_fee_estimates()
         self.queue_request('blockchain.relayfee', [])
-        for h in list(self.subscribed_addresses):
+        for h in subscribed_addresses:
             self.queue_request('blockchain.scripthash.subscribe', [h])
 
     def request_fee_estimates(self):
@@ -346,6 +426,12 @@ class Network(util.DaemonThread):
             value = self.get_servers()
         elif key == 'interfaces':
             value = self.get_interfaces()
+        elif key == 'header_cache':
+            value = blockchain.header_cache.get_stats()
+        elif key == 'response_cache':
+            value = self.response_cache.get_stats()
+        elif key == 'warm_sockets':
+            value = dict(tls_sessions.get_stats(), standby=list(self.warm_sockets))
         return value
 
     def notify(self, key):
@@ -366,6 +452,24 @@ class Network(util.DaemonThread):
         '''The interfaces that are in connected state'''
         return list(self.interfaces.keys())
 
+    def get_interface_stats(self):
+        '''Round trip time, request window and throughput of each
+        connected interface'''
+        return {server: i.get_stats() for server, i in list(self.interfaces.items())}
+
+    def get_network_stats(self):
+        '''Request counts and latencies, traffic and queues of each
+        interface, and time spent in the steps of the network loop'''
+        stats = self.stats.get_stats()
+        interfaces = self.get_interface_stats()
+        stats['interfaces'] = interfaces
+        stats['queues'] = {
+            'pending_sends': len(self.pending_sends),
+            'unsent_requests': sum(i['unsent'] for i in interfaces.values()),
+            'unanswered_requests': len(self.unanswered_requests),
+        }
+        return stats
+
     def get_servers(self):
         out = constants.net.DEFAULT_SERVERS
         if self.irc_servers:
@@ -382,18 +486,48 @@ class Network(util.DaemonThread):
 
     def start_interface(self, server):
         if (not server in self.interfaces and not server in self.connecting):
+            if server in self.warm_sockets:
+                socket, t = self.warm_sockets.pop(server)
+                self.print_error("using standby connection to", server)
+                self.new_interface(server, socket)
+                return
             if server == self.default_server:
                 self.print_error("connecting to %s as new interface" % server)
                 self.set_status('connecting')
             self.connecting.add(server)
+            if server in self.warming:
+                # already being connected to, the socket becomes an interface
+                self.warming.remove(server)
+                return
             c = Connection(server, self.socket_queue, self.config.path)
 
     def start_random_interface(self):
         exclude_set = self.disconnected_servers.union(set(self.interfaces))
-        server = pick_random_server(self.get_servers(), self.protocol, exclude_set)
+        standby = [s for s in self.warm_sockets if s not in exclude_set]
+        if standby:
+            server = self.server_scores.best(standby)
+        else:
+            server = pick_random_server(self.get_servers(), self.protocol, exclude_set)
         if server:
             self.start_interface(server)
 
+    def maintain_warm_sockets(self):
+        '''Renew old standby connections, and keep num_warm of them
+        ready to replace interfaces.'''
+        now = time.time()
+        for server, (socket, t) in list(self.warm_sockets.items()):
+            if now - t > WARM_SOCKET_MAX_AGE:
+                self.warm_sockets.pop(server)
+                socket.close()
+        if len(self.warm_sockets) + len(self.warming) >= self.num_warm:
+            return
+        exclude_set = (self.disconnected_servers | set(self.interfaces) | self.connecting
+                       | self.warming | set(self.warm_sockets))
+        server = pick_random_server(self.get_servers(), self.protocol, exclude_set)
+        if server:
+            self.warming.add(server)
+            Connection(server, self.socket_queue, self.config.path)
+
     def start_interfaces(self):
         self.start_interface(self.default_server)
         for i in range(self.num_server - 1):
@@ -439,8 +573,12 @@ class Network(util.DaemonThread):
         assert self.interface is None
         assert not self.interfaces
         self.connecting = set()
+        for socket, t in self.warm_sockets.values():
+            socket.close()
+        self.warm_sockets = {}
+        self.warming = set()
         # Get a new queue - no old pending connections thanks!
-        self.socket_queue = queue.Queue()
+        self.socket_queue = SocketQueue(self.wakeup)
 
     def set_parameters(self, host, port, protocol, proxy, auto_connect):
         proxy_str = serialize_proxy(proxy)
@@ -479,6 +617,38 @@ class Network(util.DaemonThread):
         if servers:
             self.switch_to_interface(random.choice(servers))
 
+    def switch_to_best_interface(self):
+        '''Switch to the best scoring connected server other than the
+        current one'''
+        servers = self.get_interfaces()    # Those in connected state
+        if self.default_server in servers:
+            servers.remove(self.default_server)
+        if servers:
+            self.switch_to_interface(self.server_scores.best(servers))
+
+    def update_server_scores(self):
+        '''Record how far each server lags, and switch to a server that
+        scores clearly better than ours'''
+        tips = {server: i.tip for server, i in self.interfaces.items()}
+        if tips:
+            best_tip = max(tips.values())
+            for server, tip in tips.items():
+                self.server_scores.set_lag(server, best_tip - tip)
+        if self.auto_connect and self.interface and not self.server_is_lagging():
+            servers = [s for s in tips if s != self.default_server
+                       and self.server_scores.num_samples(s) >= 10]
+            best = self.server_scores.best(servers)
+            if best and self.server_scores.score(best) < SWITCH_SCORE_RATIO * self.server_scores.score(self.default_server):
+                server, rounds = self.switch_candidate
+                rounds = rounds + 1 if server == best else 1
+                self.switch_candidate = best, rounds
+                if rounds >= SWITCH_ROUNDS and time.time() - self.interface_time > MIN_SERVER_TIME:
+                    self.print_error("switching to faster server", best)
+                    self.switch_to_interface(best)
+            else:
+                self.switch_candidate = None, 0
+        self.server_scores.save()
+
     def switch_lagging_interface(self):
         '''If auto_connect and lagging, switch interface'''
         if self.server_is_lagging() and self.auto_connect:
@@ -486,7 +656,7 @@ class Network(util.DaemonThread):
             header = self.blockchain().read_header(self.get_local_height())
             filtered = list(map(lambda x:x[0], filter(lambda x: x[1].tip_header==header, self.interfaces.items())))
             if filtered:
-                choice = random.choice(filtered)
+                choice = self.server_scores.best(filtered)
                 self.switch_to_interface(choice)
 
     def switch_to_interface(self, server):
@@ -506,6 +676,8 @@ class Network(util.DaemonThread):
             # fixme: we don't want to close headers sub
             #self.close_interface(self.interface)
             self.interface = i
+            self.interface_time = time.time()
+            self.switch_candidate = None, 0
             self.send_subscriptions()
             self.set_status('connected')
             self.notify('updated')
@@ -540,6 +712,7 @@ class Network(util.DaemonThread):
         elif method == 'blockchain.headers.subscribe':
             if error is None:
                 self.on_notify_header(interface, result)
+                self.check_reorg()
         elif method == 'server.peers.subscribe':
             if error is None:
                 self.irc_servers = parse_servers(result)
@@ -575,6 +748,7 @@ class Network(util.DaemonThread):
                 self.on_get_chunk(interface, response, height)
             else:
                 self.print_error('Unknown chunk lenght: %s' % count)
+            self.check_reorg()
 
         for callback in callbacks:
             callback(response)
@@ -590,24 +764,32 @@ class Network(util.DaemonThread):
                 method, params, message_id = request
                 k = self.get_index(method, params)
                 # client requests go through self.send() with a
-                # callback, are only sent to the current interface,
-                # and are placed in the unanswered_requests dictionary
+                # callback, are sent to the current interface unless
+                # routed, and are placed in the unanswered_requests
+                # dictionary
                 client_req = self.unanswered_requests.pop(message_id, None)
                 if client_req:
-                    assert interface == self.interface
+                    routed = self.routed_requests.pop(message_id, None)
+                    assert interface == self.interface or routed and routed[0] == interface.server
                     callbacks = [client_req[2]]
                 else:
                     # fixme: will only work for subscriptions
                     k = self.get_index(method, params)
-                    callbacks = self.subscriptions.get(k, [])
+                    callbacks = self.subscriptions.get(k)
 
                 # Copy the request method and params to the response
                 response['method'] = method
                 response['params'] = params
+                if client_req and response.get('error') is None:
+                    self.response_cache.put(method, params, response.get('result'),
+                                            self.blockchain(), self.get_local_height())
                 # Only once we've received a response to an addr subscription
-                # add it to the list; avoids double-sends on reconnection
+                # add it to the list; avoids double-sends on reconnection.
+                # Skip it if it was unsubscribed in the meantime
                 if method == 'blockchain.scripthash.subscribe':
-                    self.subscribed_addresses.add(params[0])
+                    with self.lock:
+                        if k in self.subscriptions:
+                            self.subscribed_addresses.add(params[0])
             else:
                 if not response:  # Closed remotely / misbehaving
                     self.connection_down(interface.server)
@@ -622,11 +804,13 @@ class Network(util.DaemonThread):
                 elif method == 'blockchain.scripthash.subscribe':
                     response['params'] = [params[0]]  # addr
                     response['result'] = params[1]
-                callbacks = self.subscriptions.get(k, [])
+                callbacks = self.subscriptions.get(k)
 
             # update cache if it's a subscription
             if method.endswith('.subscribe'):
-                self.sub_cache[k] = response
+                if callbacks or method != 'blockchain.scripthash.subscribe':
+                    with self.lock:
+                        self.sub_cache[k] = response
             # Response is now in canonical form
             self.process_response(interface, response, callbacks)
 
@@ -636,29 +820,47 @@ class Network(util.DaemonThread):
             self.h2addr[h] = addr
         return h
 
-    def overload_cb(self, callback):
+    def overload_cb(self, callback, h2addr):
+        '''Wrap callback to get addresses instead of the scripthashes of
+        h2addr.  The wrapper is registered as callback, so that it gets
+        removed by unsubscribe(callback).'''
+        @functools.wraps(callback)
         def cb2(x):
             x2 = x.copy()
             p = x2.pop('params')
-            addr = self.h2addr[p[0]]
+            addr = h2addr[p[0]]
             x2['params'] = [addr]
             callback(x2)
         return cb2
 
     def subscribe_to_addresses(self, addresses, callback):
-        hashes = [self.addr_to_scripthash(addr) for addr in addresses]
-        msgs = [('blockchain.scripthash.subscribe', [x]) for x in hashes]
-        self.send(msgs, self.overload_cb(callback))
+        h2addr = {self.addr_to_scripthash(addr): addr for addr in addresses}
+        msgs = [('blockchain.scripthash.subscribe', [x]) for x in h2addr]
+        self.send(msgs, self.overload_cb(callback, h2addr))
 
     def request_address_history(self, address, callback):
         h = self.addr_to_scripthash(address)
-        self.send([('blockchain.scripthash.get_history', [h])], self.overload_cb(callback))
+        self.send([('blockchain.scripthash.get_history', [h])], self.overload_cb(callback, {h: address}))
 
     def send(self, messages, callback):
         '''Messages is a list of (method, params) tuples'''
         messages = list(messages)
         with self.lock:
             self.pending_sends.append((messages, callback))
+        self.wakeup()
+
+    def wakeup(self):
+        '''Interrupt the select() of the network thread.  Can be called
+        from any thread.'''
+        try:
+            self.wakeup_w.send(b'\0')
+        except OSError:
+            # buffer full, a wakeup is pending anyway
+            pass
+
+    def stop(self):
+        util.DaemonThread.stop(self)
+        self.wakeup()
 
     def process_pending_sends(self):
         # Requests needs connectivity.  If we don't have an interface,
@@ -675,47 +877,109 @@ class Network(util.DaemonThread):
                 r = None
                 if method.endswith('.subscribe'):
                     k = self.get_index(method, params)
-                    # add callback to list
-                    l = self.subscriptions.get(k, [])
-                    if callback not in l:
-                        l.append(callback)
-                    self.subscriptions[k] = l
+                    self.subscriptions.add(k, callback)
                     # check cached response for subscriptions
                     r = self.sub_cache.get(k)
+                elif method in CACHED_METHODS:
+                    result = self.response_cache.get(method, params, self.blockchain())
+                    if result is not None:
+                        callback({'method': method, 'params': params, 'result': result})
+                        continue
                 if r is not None:
                     self.print_error("cache hit", k)
                     callback(r)
+                elif method in ROUTED_METHODS and self.config.get('route_requests'):
+                    self.route_request((method, params, callback))
                 else:
                     message_id = self.queue_request(method, params)
                     self.unanswered_requests[message_id] = method, params, callback
 
+    def route_request(self, request, exclude=()):
+        '''Send a read-only client request to the least busy interface
+        that is at the same tip as the main interface, up to
+        'route_max_requests' routed requests per server.  A server that
+        is a block behind would return a history that does not match
+        the status of our subscriptions.'''
+        limit = self.config.get('route_max_requests', 20)
+        load = defaultdict(int)
+        for server, t in self.routed_requests.values():
+            load[server] += 1
+        load[self.interface.server] = len(self.unanswered_requests) - len(self.routed_requests)
+        tip_header = self.interface.tip_header
+        candidates = [i for i in self.interfaces.values()
+                      if tip_header is not None
+                      and i.tip == self.interface.tip and i.tip_header == tip_header
+                      and i.blockchain == self.interface.blockchain
+                      and i.server not in exclude and load[i.server] < limit]
+        interface = min(candidates, key=lambda i: (load[i.server], self.server_scores.score(i.server)),
+                        default=self.interface)
+        message_id = self.queue_request(request[0], request[1], interface)
+        self.unanswered_requests[message_id] = request
+        if interface != self.interface:
+            self.routed_requests[message_id] = interface.server, time.time()
+
+    def reroute_requests(self, server=None):
+        '''Send the routed requests that went to server, or timed out,
+        to another interface'''
+        now = time.time()
+        for message_id, (s, t) in list(self.routed_requests.items()):
+            interface = self.interfaces.get(s)
+            if s == server or interface is None or now - t > interface.request_timeout():
+                self.routed_requests.pop(message_id)
+                request = self.unanswered_requests.pop(message_id, None)
+                if request is None:
+                    continue
+                if self.interface:
+                    self.route_request(request, exclude=(s,))
+                else:
+                    # resent by send_subscriptions once we are connected
+                    self.unanswered_requests[message_id] = request
+
     def unsubscribe(self, callback):
         '''Unsubscribe a callback to free object references to enable GC.'''
         # Note: we can't unsubscribe from the server, so if we receive
         # subsequent notifications process_response() will emit a harmless
         # "received unexpected notification" warning
         with self.lock:
-            for v in self.subscriptions.values():
-                if callback in v:
-                    v.remove(callback)
+            for k in self.subscriptions.remove(callback):
+                method, _, h = k.partition(':')
+                if method == 'blockchain.scripthash.subscribe':
+                    self.sub_cache.pop(k, None)
+                    self.h2addr.pop(h, None)
+                    self.subscribed_addresses.discard(h)
 
-    def connection_down(self, server):
+    def connection_down(self, server, error=True):
         '''A connection to server either went down, or was never made.
-        We distinguish by whether it is in self.interfaces.'''
+        We distinguish by whether it is in self.interfaces.  error is
+        False when the server works, but is of no use to us, so that it
+        does not count against its score.'''
         self.disconnected_servers.add(server)
+        if error:
+            self.server_scores.add_error(server)
         if server == self.default_server:
             self.set_status('disconnected')
         if server in self.interfaces:
             self.close_interface(self.interfaces[server])
             self.notify('interfaces')
+        self.reroute_requests(server)
         for b in self.blockchains.values():
             if b.catch_up == server:
                 b.catch_up = None
+        # hand chunks that were requested from server to other interfaces
+        blockchains = set()
+        for index, (interface, b, t) in list(self.requested_chunks.items()):
+            if interface.server == server:
+                self.requested_chunks.pop(index)
+                blockchains.add(b)
+        for b in blockchains:
+            self.request_more_chunks(b)
 
     def new_interface(self, server, socket):
         # todo: get tip first, then decide which checkpoint to use.
         self.add_recent_server(server)
         interface = Interface(server, socket)
+        interface.on_request_time = lambda method, rtt: self.on_request_time(server, method, rtt)
+        interface.batch_size = max(1, self.config.get('request_batch_size', interface.batch_size))
         interface.blockchain = None
         interface.tip_header = None
         interface.tip = 0
@@ -727,11 +991,32 @@ class Network(util.DaemonThread):
             self.switch_to_interface(server)
         #self.notify('interfaces')
 
+    def on_request_time(self, server, method, rtt):
+        self.stats.add_latency(method, rtt)
+        if method == 'server.ping':
+            self.server_scores.add_latency(server, rtt)
+
+    def send_score_pings(self):
+        '''Ping every interface, to score servers by comparable round
+        trips'''
+        now = time.time()
+        if now - self.score_ping_time > SCORE_PING_INTERVAL:
+            self.score_ping_time = now
+            for interface in self.interfaces.values():
+                self.queue_request('server.ping', [], interface)
+
     def maintain_sockets(self):
         '''Socket maintenance.'''
         # Responses to connection attempts?
         while not self.socket_queue.empty():
             server, socket = self.socket_queue.get()
+            if server in self.warming:
+                self.warming.remove(server)
+                if socket:
+                    self.warm_sockets[server] = (socket, time.time())
+                else:
+                    self.disconnected_servers.add(server)
+                continue
             if server in self.connecting:
                 self.connecting.remove(server)
             if socket:
@@ -747,6 +1032,7 @@ class Network(util.DaemonThread):
             elif interface.ping_required():
                 params = [ELECTRUM_VERSION, PROTOCOL_VERSION]
                 self.queue_request('server.version', params, interface)
+        self.send_score_pings()
 
         now = time.time()
         # nodes
@@ -756,12 +1042,14 @@ class Network(util.DaemonThread):
                 self.print_error('network: retrying connections')
                 self.disconnected_servers = set([])
                 self.nodes_retry_time = now
+        elif self.interfaces:
+            self.maintain_warm_sockets()
 
         # main interface
         if not self.is_connected():
             if self.auto_connect:
                 if not self.is_connecting():
-                    self.switch_to_random_interface()
+                    self.switch_to_best_interface()
             else:
                 if self.default_server in self.disconnected_servers:
                     if now - self.server_retry_time > SERVER_RETRY_INTERVAL:
@@ -773,41 +1061,184 @@ class Network(util.DaemonThread):
             if self.config.is_fee_estimates_update_required():
                 self.request_fee_estimates()
 
-    def request_chunk(self, interface, index):
-        if index in self.requested_chunks:
+        if now - self.scores_time > SCORES_INTERVAL:
+            self.scores_time = now
+            self.update_server_scores()
+
+    def request_chunk(self, interface, index, blockchain=None):
+        if index in self.requested_chunks or index in self.verifying_chunks:
             return
         interface.print_error("requesting chunk %d" % index)
-        self.requested_chunks.add(index)
+        if blockchain is None:
+            blockchain = interface.blockchain
+        self.requested_chunks[index] = interface, blockchain, time.time()
         self.queue_request('blockchain.block.headers',
                            [CHUNK_LEN*index, CHUNK_LEN], interface)
 
+    def get_catch_up_interface(self, blockchain):
+        interface = self.interfaces.get(blockchain.catch_up)
+        if interface and interface.mode == 'catch_up' and interface.blockchain == blockchain:
+            return interface
+
+    def request_more_chunks(self, blockchain, exclude=()):
+        '''Keep up to 'chunk_window' chunk requests in flight for the
+        chain being caught up, spread over the connected interfaces that
+        have the headers.  Chunks arriving out of order wait in
+        verifying_chunks until they can be connected.'''
+        catch_up = self.get_catch_up_interface(blockchain)
+        if catch_up is None:
+            return
+        first = (blockchain.height() + 1) // CHUNK_LEN
+        last = min(catch_up.tip // CHUNK_LEN, first + self.config.get('chunk_window', 10) - 1)
+        for index in range(first, last + 1):
+            if index in self.requested_chunks or index in self.verifying_chunks:
+                continue
+            interface = self.pick_chunk_interface(catch_up, index, exclude)
+            self.request_chunk(interface, index, blockchain)
+
+    def pick_chunk_interface(self, catch_up, index, exclude):
+        '''The least loaded interface that can serve chunk index of the
+        chain catch_up is following, defaulting to catch_up itself'''
+        top = min((index + 1) * CHUNK_LEN - 1, catch_up.tip)
+        load = defaultdict(int)
+        for i, b, t in self.requested_chunks.values():
+            load[i.server] += 1
+        candidates = [i for i in self.interfaces.values()
+                      if i.tip >= top and i.blockchain in (None, catch_up.blockchain)
+                      and i.server not in exclude]
+        if not candidates:
+            return catch_up
+        # prefer catch_up on ties
+        return min(candidates, key=lambda i: (load[i.server], i != catch_up))
+
     def on_get_chunk(self, interface, response, height):
         '''Handle receiving a chunk of block headers'''
         error = response.get('error')
         result = response.get('result')
-        blockchain = interface.blockchain
+        index = height // CHUNK_LEN
+        # Ignore unsolicited chunks, or late ones that were reassigned
+        request = self.requested_chunks.get(index)
+        if request is None or request[0] != interface:
+            interface.print_error("received chunk %d (unsolicited)" % index)
+            return
+        blockchain = request[1]
+        self.requested_chunks.pop(index)
         if result is None or error is not None:
             interface.print_error(error or 'bad response')
+            self.request_more_chunks(blockchain, exclude=(interface.server,))
             return
-        index = height // CHUNK_LEN
-        # Ignore unsolicited chunks
-        if index not in self.requested_chunks:
-            interface.print_error("received chunk %d (unsolicited)" % index)
+        interface.print_error("received chunk %d" % index)
+        try:
+            data = bfh(result.get('hex', None))
+        except BaseException as e:
+            interface.print_error('bad chunk %d' % index, e)
+            self.connection_down(interface.server)
             return
+        # process_chunks connects it
+        positions = self.equihash_positions(height, data)
+        if positions:
+            # equihash solutions are checked by worker processes
+            hashes = self.get_chunk_pool().apply_async(hash_chunk, (height, data, positions),
+                                                       callback=lambda r: self.wakeup(),
+                                                       error_callback=lambda e: self.wakeup())
         else:
-            interface.print_error("received chunk %d" % index)
-        self.requested_chunks.remove(index)
-        hex_chunk = result.get('hex', None)
-        connect = blockchain.connect_chunk(index, hex_chunk)
-        if not connect:
+            # hashing is cheaper than sending the chunk to a worker
+            try:
+                hashes = hash_chunk(height, data)
+            except BaseException as e:
+                interface.print_error('bad chunk %d' % index, e)
+                self.on_bad_chunk(interface, blockchain)
+                return
+        self.verifying_chunks[index] = interface, blockchain, data, hashes
+
+    def equihash_positions(self, height, data):
+        '''Positions of the headers of a chunk whose equihash solution
+        is checked, according to the 'equihash' setting: None (default),
+        'sample' or 'full'.'''
+        mode = self.config.get('equihash')
+        if not mode:
+            return ()
+        count = 0
+        offset = 0
+        while offset < len(data):
+            offset += get_header_size(height + count)
+            count += 1
+        if mode == 'full':
+            return range(count)
+        n = min(count, self.config.get('equihash_samples', 8))
+        return random.sample(range(count), n)
+
+    def get_chunk_pool(self):
+        '''Pool checking the equihash solutions of chunks: a thread,
+        until the worker processes have answered a first job.'''
+        if self.chunk_pool is None:
+            self.chunk_pool = multiprocessing.pool.ThreadPool(1)
+            n = self.config.get('chunk_workers', min(4, os.cpu_count() or 1))
+            try:
+                if 'ANDROID_DATA' in os.environ:
+                    raise Exception('no multiprocessing on Android')
+                pool = multiprocessing.get_context('spawn').Pool(n)
+                probe = pool.apply_async(hash_chunk, (0, b''), callback=lambda r: self.wakeup(),
+                                         error_callback=lambda e: self.wakeup())
+                self.chunk_workers = pool, probe, time.time()
+            except BaseException as e:
+                self.print_error('cannot start chunk workers, checking in a thread:', e)
+        if self.chunk_workers:
+            pool, probe, start_time = self.chunk_workers
+            if probe.ready() and probe.successful():
+                # jobs already given to the thread complete there
+                self.chunk_pool.close()
+                self.chunk_pool = pool
+                self.chunk_workers = None
+            elif probe.ready() or time.time() - start_time > 10:
+                # workers that cannot import us would never return
+                self.print_error('cannot start chunk workers, checking in a thread')
+                pool.terminate()
+                self.chunk_workers = None
+        return self.chunk_pool
+
+    def process_chunks(self):
+        '''Verify and save hashed chunks in order of their index.  Chunks
+        are only written from here, on the network thread.  A chunk that
+        arrived ahead of its predecessor stays buffered until the gap is
+        filled.'''
+        for index in sorted(self.verifying_chunks):
+            interface, blockchain, data, hashes = self.verifying_chunks[index]
+            if not isinstance(hashes, list) and not hashes.ready():
+                break
+            if index * CHUNK_LEN > blockchain.height() + 1:
+                if self.get_catch_up_interface(blockchain) is None:
+                    # nobody is going to fill the gap anymore
+                    self.verifying_chunks.pop(index)
+                    continue
+                break
+            self.verifying_chunks.pop(index)
+            try:
+                if not isinstance(hashes, list):
+                    hashes = hashes.get()
+            except BaseException as e:
+                interface.print_error('bad chunk %d' % index, e)
+                self.on_bad_chunk(interface, blockchain)
+                continue
+            self.on_chunk_hashed(interface, blockchain, index, data, hashes)
+
+    def on_bad_chunk(self, interface, blockchain):
+        if interface.server in self.interfaces:
             self.connection_down(interface.server)
+        self.request_more_chunks(blockchain, exclude=(interface.server,))
+
+    def on_chunk_hashed(self, interface, blockchain, index, data, hashes):
+        connect = blockchain.connect_chunk(index, data, hashes)
+        if not connect:
+            self.on_bad_chunk(interface, blockchain)
             return
-        # If not finished, get the next chunk
-        if index >= len(blockchain.checkpoints) and blockchain.height() < interface.tip:
-            self.request_chunk(interface, index+1)
-        else:
-            interface.mode = 'default'
-            interface.print_error('catch up done', blockchain.height())
+        catch_up = self.get_catch_up_interface(blockchain)
+        # If not finished, keep the window of chunk requests full
+        if catch_up and index >= len(blockchain.checkpoints) and blockchain.height() < catch_up.tip:
+            self.request_more_chunks(blockchain)
+        elif catch_up and not any(b == blockchain for i, b, t in self.requested_chunks.values()):
+            catch_up.mode = 'default'
+            catch_up.print_error('catch up done', blockchain.height())
             blockchain.catch_up = None
         self.notify('updated')
 
@@ -856,7 +1287,7 @@ class Network(util.DaemonThread):
                 assert next_height >= self.max_checkpoint(), (interface.bad, interface.good)
             else:
                 if height == 0:
-                    self.connection_down(interface.server)
+                    self.connection_down(interface.server, error=False)
                     next_height = None
                 else:
                     interface.bad = height
@@ -875,7 +1306,7 @@ class Network(util.DaemonThread):
                 next_height = (interface.bad + interface.good) // 2
                 assert next_height >= self.max_checkpoint()
             elif not interface.blockchain.can_connect(interface.bad_header, check_height=False):
-                self.connection_down(interface.server)
+                self.connection_down(interface.server, error=False)
                 next_height = None
             else:
                 branch = self.blockchains.get(interface.bad)
@@ -943,7 +1374,10 @@ class Network(util.DaemonThread):
         interface.request = None
         if next_height:
             if interface.mode == 'catch_up' and interface.tip > next_height + 50:
-                self.request_chunk(interface, next_height // CHUNK_LEN)
+                if self.get_catch_up_interface(interface.blockchain) == interface:
+                    self.request_more_chunks(interface.blockchain)
+                else:
+                    self.request_chunk(interface, next_height // CHUNK_LEN)
             else:
                 self.request_header(interface, next_height)
         else:
@@ -958,17 +1392,22 @@ class Network(util.DaemonThread):
                 interface.print_error("blockchain request timed out")
                 self.connection_down(interface.server)
                 continue
+        self.reroute_requests()
+        # hand slow chunk requests to another interface
+        now = time.time()
+        for index, (interface, b, t) in list(self.requested_chunks.items()):
+            if now - t > CHUNK_REQUEST_TIMEOUT:
+                interface.print_error("chunk request %d timed out" % index)
+                self.requested_chunks.pop(index)
+                self.request_more_chunks(b, exclude=(interface.server,))
 
     def wait_on_sockets(self):
-        # Python docs say Windows doesn't like empty selects.
-        # Sleep to prevent busy looping
-        if not self.interfaces:
-            time.sleep(0.1)
-            return
-        rin = [i for i in self.interfaces.values()]
+        # The wakeup socket keeps the select from being empty, which
+        # Windows does not like
+        rin = [self.wakeup_r] + list(self.interfaces.values())
         win = [i for i in self.interfaces.values() if i.num_requests()]
         try:
-            rout, wout, xout = select.select(rin, win, [], 0.1)
+            rout, wout, xout = select.select(rin, win, [], SELECT_TIMEOUT)
         except socket.error as e:
             # TODO: py3, get code from e
             code = None
@@ -979,8 +1418,18 @@ class Network(util.DaemonThread):
         for interface in wout:
             interface.send_requests()
         for interface in rout:
+            if interface is self.wakeup_r:
+                self.drain_wakeups()
+                continue
             self.process_responses(interface)
 
+    def drain_wakeups(self):
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except OSError:
+            pass
+
     def init_headers_file(self):
         b = self.blockchains[0]
         filename = b.path()
@@ -996,18 +1445,44 @@ class Network(util.DaemonThread):
                         bin_header = bfh(header_data)
                         f.write(bin_header)
         with b.lock:
-            b.update_size(0)
+            b.update_size()
+        snapshot = self.config.get('headers_snapshot')
+        if snapshot and os.path.exists(snapshot):
+            height = b.height()
+            n = b.import_snapshot(snapshot)
+            self.print_error("imported %d chunks from snapshot, height %d -> %d" % (n, height, b.height()))
 
     def run(self):
         self.init_headers_file()
         while self.is_running():
-            self.maintain_sockets()
-            self.wait_on_sockets()
-            self.maintain_requests()
-            self.run_jobs()    # Synchronizer and Verifier
-            self.process_pending_sends()
+            self.timed(self.maintain_sockets)
+            self.timed(self.wait_on_sockets)
+            self.timed(self.process_chunks)
+            self.timed(self.maintain_requests)
+            self.timed(self.run_jobs)    # Synchronizer and Verifier
+            self.timed(self.process_pending_sends)
+            self.timed(self.flush_headers, 1)
         self.stop_network()
+        if self.chunk_pool:
+            self.chunk_pool.terminate()
+        if self.chunk_workers:
+            self.chunk_workers[0].terminate()
+        self.flush_headers()
+        self.server_scores.save()
+        self.response_cache.save()
         self.on_stop()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+
+    def timed(self, step, *args):
+        t = time.time()
+        step(*args)
+        self.stats.add_step(step.__name__, time.time() - t)
+
+    def flush_headers(self, idle=0):
+        '''Write the headers buffered by the blockchains for idle seconds'''
+        for b in list(self.blockchains.values()):
+            b.flush(idle)
 
     def on_notify_header(self, interface, header):
         height = header.get('height')
@@ -1022,7 +1497,7 @@ class Network(util.DaemonThread):
 
         header = blockchain.deserialize_header(bfh(hex_header), height)
         if height < self.max_checkpoint():
-            self.connection_down(interface.server)
+            self.connection_down(interface.server, error=False)
             return
         interface.tip_header = header
         interface.tip = height
@@ -1052,13 +1527,25 @@ class Network(util.DaemonThread):
         else:
             chain = self.blockchains[0]
             if chain.catch_up is None:
-                chain.catch_up = interface
+                chain.catch_up = interface.server
                 interface.mode = 'catch_up'
                 interface.blockchain = chain
                 self.print_error("switching to catchup mode", tip,  self.blockchains)
                 self.request_header(interface, 0)
             else:
-                self.print_error("chain already catching up with", chain.catch_up.server)
+                self.print_error("chain already catching up with", chain.catch_up)
+
+    def check_reorg(self):
+        '''Drop cached responses about blocks that left our chain, if the
+        block at the height of our previous tip has changed.'''
+        b = self.blockchain()
+        height = b.height()
+        if self.main_tip is not None:
+            tip, tip_hash = self.main_tip
+            if tip > height or blockchain.hash_header(b.read_header(tip)) != tip_hash:
+                self.print_error("reorg below", tip)
+                self.response_cache.invalidate(b)
+        self.main_tip = height, blockchain.hash_header(b.read_header(height))
 
     def blockchain(self):
         if self.interface and self.interface.blockchain is not None:
@@ -1095,6 +1582,10 @@ class Network(util.DaemonThread):
         return self.blockchain().height()
 
     def synchronous_get(self, request, timeout=30):
+        if request[0] in CACHED_METHODS:
+            result = self.response_cache.get(request[0], request[1], self.blockchain())
+            if result is not None:
+                return result
         q = queue.Queue()
         self.send([request], q.put)
         try:
@@ -0,0 +1,172 @@
+# Electrum - Lightweight ZClassic Client
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import threading
+import time
+from collections import defaultdict
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from .util import PrintError
+
+
+# upper bounds of the request latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+
+def format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+class NetworkStats(object):
+    '''Counters of the network thread: requests sent and latency
+    histograms per method, and time spent in each step of the main loop.
+    Traffic and queue depths are read from the interfaces when
+    Network.get_network_stats is called.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.requests = defaultdict(int)
+        # method -> [count per bucket, number of responses, total latency]
+        self.latencies = {}
+        # step -> [calls, total time, longest call]
+        self.steps = {}
+
+    def add_request(self, method):
+        with self.lock:
+            self.requests[method] += 1
+
+    def add_latency(self, method, seconds):
+        with self.lock:
+            h = self.latencies.get(method)
+            if h is None:
+                h = self.latencies[method] = [[0] * len(LATENCY_BUCKETS), 0, 0.]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    h[0][i] += 1
+                    break
+            h[1] += 1
+            h[2] += seconds
+
+    def add_step(self, step, seconds):
+        with self.lock:
+            s = self.steps.get(step)
+            if s is None:
+                s = self.steps[step] = [0, 0., 0.]
+            s[0] += 1
+            s[1] += seconds
+            s[2] = max(s[2], seconds)
+
+    def get_stats(self):
+        with self.lock:
+            requests = {}
+            for method in set(self.requests) | set(self.latencies):
+                buckets, count, total = self.latencies.get(method, [[0] * len(LATENCY_BUCKETS), 0, 0.])
+                cumulative = []
+                n = 0
+                for bound, c in zip(LATENCY_BUCKETS, buckets):
+                    n += c
+                    cumulative.append([format_bound(bound), n])
+                requests[method] = {
+                    'sent': self.requests.get(method, 0),
+                    'responses': count,
+                    'latency_sum': total,
+                    'latency_buckets': cumulative,
+                }
+            loop = {step: {'calls': s[0], 'seconds': s[1], 'max_seconds': s[2]}
+                    for step, s in self.steps.items()}
+        return {'uptime': time.time() - self.start_time, 'requests': requests, 'loop': loop}
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def to_prometheus(stats):
+    '''Render the output of Network.get_network_stats in the Prometheus
+    text exposition format.'''
+    lines = []
+
+    def metric(name, kind, doc, samples):
+        lines.append('# HELP %s %s' % (name, doc))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for suffix, labels, value in samples:
+            label_str = ','.join('%s="%s"' % (k, escape_label(v)) for k, v in labels)
+            lines.append('%s%s%s %s' % (name, suffix, '{%s}' % label_str if label_str else '', value))
+
+    requests = sorted(stats['requests'].items())
+    metric('electrum_requests_total', 'counter', 'Requests sent to servers.',
+           [('', [('method', m)], r['sent']) for m, r in requests])
+    samples = []
+    for m, r in requests:
+        for bound, n in r['latency_buckets']:
+            samples.append(('_bucket', [('method', m), ('le', bound)], n))
+        samples.append(('_sum', [('method', m)], r['latency_sum']))
+        samples.append(('_count', [('method', m)], r['responses']))
+    metric('electrum_request_latency_seconds', 'histogram', 'Time until a request was answered.', samples)
+    interfaces = sorted(stats['interfaces'].items())
+    metric('electrum_interface_sent_bytes_total', 'counter', 'Bytes sent to each server.',
+           [('', [('server', s)], i['bytes_sent']) for s, i in interfaces])
+    metric('electrum_interface_received_bytes_total', 'counter', 'Bytes received from each server.',
+           [('', [('server', s)], i['bytes_received']) for s, i in interfaces])
+    metric('electrum_queue_depth', 'gauge', 'Requests waiting in the queues of the network thread.',
+           [('', [('queue', q)], n) for q, n in sorted(stats['queues'].items())])
+    loop = sorted(stats['loop'].items())
+    metric('electrum_loop_seconds_total', 'counter', 'Time spent in each step of the network loop.',
+           [('', [('step', s)], l['seconds']) for s, l in loop])
+    metric('electrum_loop_calls_total', 'counter', 'Calls of each step of the network loop.',
+           [('', [('step', s)], l['calls']) for s, l in loop])
+    metric('electrum_loop_max_seconds', 'gauge', 'Longest call of each step of the network loop.',
+           [('', [('step', s)], l['max_seconds']) for s, l in loop])
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(threading.Thread, PrintError):
+    '''Serves the network stats at /metrics for Prometheus.'''
+
+    def __init__(self, network, host, port):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = to_prometheus(network.get_network_stats()).encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer((host, port), Handler)
+
+    def run(self):
+        self.print_error("serving metrics on", self.server.server_address)
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
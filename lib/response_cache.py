@@ -0,0 +1,166 @@
+# Electrum - Lightweight ZClassic Client
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import os
+import json
+import copy
+import threading
+from collections import OrderedDict
+
+from .util import PrintError
+from .blockchain import hash_header
+
+
+# blocks on top of a block before responses about it are cached
+MIN_DEPTH = 6
+# the methods whose responses are cached
+CACHED_METHODS = {
+    'blockchain.transaction.get',
+    'blockchain.transaction.get_merkle',
+    'blockchain.block.header',
+    'blockchain.block.headers',
+}
+
+
+def get_cache_height(method, params, result, local_height):
+    '''Returns the height of the block a response depends on, None if it
+    does not depend on any, or False if it must not be cached.'''
+    if method not in CACHED_METHODS:
+        return False
+    if method == 'blockchain.transaction.get':
+        # the txid commits to the raw transaction, but not to the
+        # confirmations returned in verbose mode
+        return None if len(params) == 1 or not params[1] else False
+    if method == 'blockchain.transaction.get_merkle':
+        height = result.get('block_height') if isinstance(result, dict) else None
+    elif method == 'blockchain.block.header':
+        height = params[0]
+    else:
+        height = params[0] + params[1] - 1
+    if not isinstance(height, int) or height <= 0 or height > local_height - MIN_DEPTH + 1:
+        return False
+    return height
+
+
+class ResponseCache(PrintError):
+    '''Least recently used cache of responses that cannot change: raw
+    transactions, and merkle branches and headers of buried blocks,
+    keyed by method and params.  Responses about a block are kept with
+    its hash, and dropped once the block is no longer in the chain.
+    Saved to 'response_cache' if a path is given.'''
+
+    def __init__(self, max_size, path=None):
+        self.max_size = max_size
+        self.path = os.path.join(path, 'response_cache') if path else None
+        self.lock = threading.Lock()
+        # (method, params) -> (result, height, block hash)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    @staticmethod
+    def get_key(method, params):
+        return method + ':' + json.dumps(params)
+
+    @staticmethod
+    def get_block_hash(blockchain, height):
+        return hash_header(blockchain.read_header(height))
+
+    def get(self, method, params, blockchain):
+        if method not in CACHED_METHODS:
+            # not a miss, it cannot hit
+            return None
+        key = self.get_key(method, params)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None:
+            result, height, block_hash = entry
+            if height is not None and self.get_block_hash(blockchain, height) != block_hash:
+                with self.lock:
+                    self.entries.pop(key, None)
+                entry = None
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if key in self.entries:
+                self.entries.move_to_end(key)
+        return copy.deepcopy(result)
+
+    def put(self, method, params, result, blockchain, local_height):
+        if self.max_size <= 0 or result is None:
+            return
+        height = get_cache_height(method, params, result, local_height)
+        if height is False:
+            return
+        block_hash = None
+        if height is not None:
+            block_hash = self.get_block_hash(blockchain, height)
+            if block_hash == '0' * 64:
+                return
+        key = self.get_key(method, params)
+        with self.lock:
+            self.entries[key] = (copy.deepcopy(result), height, block_hash)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, blockchain):
+        '''Drop the responses about blocks that blockchain does not have,
+        after a reorg.'''
+        with self.lock:
+            items = [(key, entry[1], entry[2]) for key, entry in self.entries.items()
+                     if entry[1] is not None]
+        stale = [key for key, height, block_hash in items
+                 if self.get_block_hash(blockchain, height) != block_hash]
+        with self.lock:
+            for key in stale:
+                self.entries.pop(key, None)
+        if stale:
+            self.print_error("dropped %d responses after reorg" % len(stale))
+
+    def get_stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+    def load(self):
+        if not self.path or self.max_size <= 0 or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.loads(f.read())
+            for key, result, height, block_hash in data[-self.max_size:]:
+                self.entries[key] = (result, height, block_hash)
+        except Exception as e:
+            self.print_error('cannot read response cache', e)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = [[key] + list(entry) for key, entry in self.entries.items()]
+        try:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(data))
+        except:
+            pass
@@ -0,0 +1,132 @@
+# Electrum - Lightweight ZClassic Client
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import os
+import json
+import threading
+from collections import deque
+
+from .util import PrintError
+
+
+# latency samples kept per server
+NUM_SAMPLES = 100
+# weight of the latest event in the error rate
+ERROR_ALPHA = 0.05
+# seconds of latency a server is charged per block it lags behind
+LAG_PENALTY = 5
+ERROR_PENALTY = 10
+# latency assumed for servers we have not measured yet
+DEFAULT_LATENCY = 1.
+
+
+def percentile(samples, p):
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(p * len(s)))]
+
+
+class ServerScores(PrintError):
+    '''Rolling latency percentiles, error rate and tip lag of servers,
+    combined into a score in seconds; lower is better.  Saved to
+    'server_scores' next to 'recent_servers'.'''
+
+    def __init__(self, path):
+        self.path = os.path.join(path, 'server_scores') if path else None
+        self.lock = threading.Lock()
+        self.servers = {}
+        self.load()
+
+    def get(self, server):
+        s = self.servers.get(server)
+        if s is None:
+            s = self.servers[server] = {'latencies': deque(maxlen=NUM_SAMPLES),
+                                        'error_rate': 0., 'lag': 0}
+        return s
+
+    def add_latency(self, server, latency):
+        with self.lock:
+            s = self.get(server)
+            s['latencies'].append(latency)
+            s['error_rate'] *= 1 - ERROR_ALPHA
+
+    def add_error(self, server):
+        with self.lock:
+            s = self.get(server)
+            s['error_rate'] = (1 - ERROR_ALPHA) * s['error_rate'] + ERROR_ALPHA
+
+    def set_lag(self, server, lag):
+        with self.lock:
+            self.get(server)['lag'] = max(0, lag)
+
+    def num_samples(self, server):
+        with self.lock:
+            s = self.servers.get(server)
+            return len(s['latencies']) if s else 0
+
+    def score(self, server):
+        with self.lock:
+            s = self.servers.get(server)
+            if s is None:
+                return 1.5 * DEFAULT_LATENCY
+            latencies = s['latencies']
+            if latencies:
+                latency = percentile(latencies, 0.5) + 0.5 * percentile(latencies, 0.9)
+            else:
+                latency = 1.5 * DEFAULT_LATENCY
+            return latency + ERROR_PENALTY * s['error_rate'] + LAG_PENALTY * s['lag']
+
+    def best(self, servers):
+        servers = list(servers)
+        return min(servers, key=self.score) if servers else None
+
+    def get_stats(self):
+        with self.lock:
+            servers = list(self.servers)
+        return {server: {'score': self.score(server),
+                         'samples': self.num_samples(server)}
+                for server in servers}
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.loads(f.read())
+            for server, s in data.items():
+                self.servers[server] = {
+                    'latencies': deque(s['latencies'], maxlen=NUM_SAMPLES),
+                    'error_rate': s['error_rate'],
+                    'lag': s['lag'],
+                }
+        except Exception as e:
+            self.print_error('cannot read server scores', e)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = {server: dict(s, latencies=list(s['latencies']))
+                    for server, s in self.servers.items()}
+        try:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(data, indent=4, sort_keys=True))
+        except:
+            pass
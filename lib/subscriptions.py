@@ -0,0 +1,72 @@
+# Electrum - Lightweight ZClassic Client
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import threading
+
+
+class SubscriptionRegistry(object):
+    '''Callbacks of subscriptions by key, with the reverse index from
+    callbacks to their keys, so that unsubscribing costs as much as the
+    subscriptions of that callback.  Wrapped callbacks (with __wrapped__
+    set, as by functools.wraps) are indexed by the callback they wrap:
+    subscribing the same callback twice to a key keeps one of them, and
+    removing the callback removes its wrappers.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> {owner: callback}, in subscription order
+        self.callbacks = {}
+        # owner -> set of keys
+        self.keys = {}
+
+    @staticmethod
+    def get_owner(callback):
+        return getattr(callback, '__wrapped__', callback)
+
+    def add(self, key, callback):
+        owner = self.get_owner(callback)
+        with self.lock:
+            self.callbacks.setdefault(key, {})[owner] = callback
+            self.keys.setdefault(owner, set()).add(key)
+
+    def get(self, key):
+        with self.lock:
+            return list(self.callbacks.get(key, {}).values())
+
+    def remove(self, callback):
+        '''Remove the subscriptions of callback.  Returns the keys that
+        have no subscriber left.'''
+        owner = self.get_owner(callback)
+        unused = []
+        with self.lock:
+            for key in self.keys.pop(owner, ()):
+                callbacks = self.callbacks[key]
+                callbacks.pop(owner, None)
+                if not callbacks:
+                    del self.callbacks[key]
+                    unused.append(key)
+        return unused
+
+    def __contains__(self, key):
+        return key in self.callbacks
+
+    def __len__(self):
+        return len(self.callbacks)
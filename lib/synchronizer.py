@@ -71,6 +71,7 @@ class Synchronizer(ThreadJob):
         '''This can be called from the proxy or GUI threads.'''
         with self.lock:
             self.new_addresses.add(address)
+        self.network.wakeup()
 
     def subscribe_to_addresses(self, addresses):
         if addresses:
@@ -0,0 +1,201 @@
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+from lib import blockchain
+from lib.util import bfh
+from lib.simple_config import SimpleConfig
+
+
+def make_raw_header(timestamp, bits):
+    return (struct.pack('<I', 4) + os.urandom(96)
+            + struct.pack('<II', timestamp, bits)
+            + bytes(32) + b'\xfd\x40\x05' + bytes(1344))
+
+
+class TestBlockchain(unittest.TestCase):
+
+    def setUp(self):
+        super(TestBlockchain, self).setUp()
+        self.electrum_dir = tempfile.mkdtemp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_dir})
+        blockchain.blockchains.clear()
+        random.seed(42)
+        self.raw_headers = []
+        timestamp = 1478403829
+        for height in range(400):
+            timestamp += random.randint(-300, 900)
+            bits = random.randint(0x1d, 0x1f) << 24 | random.randint(0x8000, 0x7fffff)
+            self.raw_headers.append(make_raw_header(timestamp, bits))
+
+    def tearDown(self):
+        super(TestBlockchain, self).tearDown()
+        blockchain.blockchains.clear()
+        shutil.rmtree(self.electrum_dir)
+
+    def make_chain(self, size):
+        b = blockchain.Blockchain(self.config, 0, None)
+        blockchain.blockchains[0] = b
+        with open(b.path(), 'wb') as f:
+            f.write(b''.join(self.raw_headers[:size]))
+        with b.lock:
+            b.update_size()
+        return b
+
+    def test_target_window_matches_get_target(self):
+        b = self.make_chain(len(self.raw_headers))
+        window = blockchain.TargetWindow(b, 0)
+        for height in range(len(self.raw_headers)):
+            self.assertEqual(b.get_target(height), window.get_target(height))
+            window.add_header(b.read_header(height))
+
+    def test_target_window_matches_get_target_in_chunk(self):
+        b = self.make_chain(200)
+        window = blockchain.TargetWindow(b, 200)
+        chunk_headers = {'empty': True, 'min_height': 200}
+        for height in range(200, 300):
+            header = blockchain.deserialize_header(self.raw_headers[height], height)
+            self.assertEqual(b.get_target(height, chunk_headers),
+                             window.get_target(height, chunk_headers))
+            chunk_headers[height] = header
+            chunk_headers['max_height'] = height
+            chunk_headers['empty'] = False
+            window.add_header(header)
+
+    def test_index_matches_headers(self):
+        b = self.make_chain(300)
+        for height in range(1, 300):
+            header = b.read_header(height)
+            self.assertEqual(blockchain.hash_header(header), b.get_hash(height))
+            self.assertEqual(header['timestamp'], b.get_timestamp(height))
+            self.assertEqual(header['bits'], b.get_bits(height))
+            self.assertEqual(header['merkle_root'], b.get_merkle_root(height))
+
+    def test_index_rewrite_in_place(self):
+        b = self.make_chain(300)
+        self.assertEqual(b.get_hash(299), blockchain.hash_header(b.read_header(299)))
+        # rewriting a checkpointed chunk keeps the records after it
+        with mock.patch.object(b, 'checkpoints', [None] * 3):
+            b.save_chunk(100, b''.join(self.raw_headers[100:200]))
+        self.assertEqual(300 * blockchain.INDEX_RECORD_LEN, len(b._index))
+        self.assertEqual(300 * blockchain.INDEX_RECORD_LEN, os.path.getsize(b.index_path()))
+
+    def test_index_large_gap(self):
+        b = self.make_chain(300)
+        b.truncate_index(0)
+        with mock.patch.object(blockchain, 'INDEX_FILL_LEN', 50):
+            # not built inline past the records
+            self.assertEqual(blockchain.hash_header(b.read_header(299)), b.get_hash(299))
+            self.assertEqual(0, len(b._index))
+            self.assertEqual(blockchain.hash_header(b.read_header(20)), b.get_hash(20))
+            self.assertEqual(21 * blockchain.INDEX_RECORD_LEN, len(b._index))
+            b.flush()
+            self.assertEqual(71 * blockchain.INDEX_RECORD_LEN, len(b._index))
+
+    def test_buffered_headers(self):
+        b = self.make_chain(100)
+        for height in range(100, 110):
+            b.save_header(blockchain.deserialize_header(self.raw_headers[height], height))
+        self.assertEqual(109, b.height())
+        self.assertEqual(100 * blockchain.HDR_LEN, os.path.getsize(b.path()))
+        self.assertEqual(self.raw_headers[105], bytes(b.read_raw_header(105)))
+        b.flush()
+        self.assertEqual(110 * blockchain.HDR_LEN, os.path.getsize(b.path()))
+        self.assertEqual(self.raw_headers[105], bytes(b.read_raw_header(105)))
+
+    def test_read_header_across_truncate(self):
+        b = self.make_chain(100)
+        h = b.read_raw_header(90)
+        # a reorg truncates the file under the mapping
+        b.write(self.raw_headers[50], 50 * blockchain.HDR_LEN)
+        self.assertIsNone(b._mmap)
+        self.assertEqual(50, b.height())
+        self.assertEqual(self.raw_headers[90], h)
+        self.assertEqual(self.raw_headers[50], b.read_raw_header(50))
+
+    def test_torn_tail_is_trimmed(self):
+        b = self.make_chain(100)
+        with open(b.path(), 'ab') as f:
+            f.write(self.raw_headers[100][:500])
+        b = blockchain.Blockchain(self.config, 0, None)
+        self.assertEqual(99, b.height())
+        self.assertEqual(100 * blockchain.HDR_LEN, os.path.getsize(b.path()))
+
+    def test_fork_after_bubbles(self):
+        checkpoint = blockchain.BUBBLES_ACTIVATION_HEIGHT + 1000
+        b = blockchain.Blockchain(self.config, checkpoint, 0)
+        os.makedirs(os.path.dirname(b.path()), exist_ok=True)
+        headers = [os.urandom(blockchain.HDR_EH_192_7_LEN) for i in range(3)]
+        with open(b.path(), 'wb') as f:
+            f.write(b''.join(headers))
+        b = blockchain.Blockchain(self.config, checkpoint, 0)
+        self.assertEqual(3 * blockchain.HDR_EH_192_7_LEN, os.path.getsize(b.path()))
+        self.assertEqual(checkpoint + 2, b.height())
+        self.assertEqual(headers[1], bytes(b.read_raw_header(checkpoint + 1)))
+        # a torn header is still trimmed
+        with open(b.path(), 'ab') as f:
+            f.write(os.urandom(100))
+        b = blockchain.Blockchain(self.config, checkpoint, 0)
+        self.assertEqual(3 * blockchain.HDR_EH_192_7_LEN, os.path.getsize(b.path()))
+
+    def test_header_cache(self):
+        b = self.make_chain(200)
+        stats = blockchain.header_cache.get_stats()
+        header = b.read_header(150)
+        self.assertEqual(header, b.read_header(150))
+        self.assertEqual(stats['hits'] + 1, blockchain.header_cache.get_stats()['hits'])
+        # rewriting the chunk replaces the cached header
+        b.write(b''.join(self.raw_headers[200:300]), 100 * blockchain.HDR_LEN)
+        self.assertEqual(self.raw_headers[250], bfh(blockchain.serialize_header(b.read_header(150))))
+
+    def test_block_header(self):
+        raw = self.raw_headers[10]
+        header = blockchain.deserialize_header(raw, 10)
+        self.assertEqual(4, header['version'])
+        self.assertEqual(10, header.get('block_height'))
+        self.assertEqual(raw, bfh(blockchain.serialize_header(header)))
+        d = dict(header)
+        self.assertEqual(header, d)
+        self.assertEqual(blockchain.hash_header(d), blockchain.hash_header(header))
+        header['nonce'] = 'ff' * 32
+        self.assertEqual(raw[:108], header.raw[:108])
+        self.assertNotEqual(blockchain.hash_header(d), blockchain.hash_header(header))
+
+    def test_check_header(self):
+        b = self.make_chain(100)
+        header = b.read_header(50)
+        self.assertIsInstance(header, blockchain.BlockHeader)
+        self.assertEqual(b, blockchain.check_header(header))
+        self.assertEqual(b, blockchain.check_header(dict(header)))
+        self.assertFalse(blockchain.check_header(blockchain.deserialize_header(self.raw_headers[150], 50)))
+        self.assertFalse(blockchain.check_header(None))
+
+    def test_import_snapshot(self):
+        # link the headers
+        for height in range(1, 300):
+            prev_hash = blockchain.hash_header(blockchain.deserialize_header(self.raw_headers[height - 1], height - 1))
+            raw = self.raw_headers[height]
+            self.raw_headers[height] = raw[:4] + bfh(prev_hash)[::-1] + raw[36:]
+        snapshot = os.path.join(self.electrum_dir, 'snapshot')
+        with open(snapshot, 'wb') as f:
+            f.write(b''.join(self.raw_headers[:300]))
+        checkpoints = self.make_chain(300).get_checkpoints()
+        self.assertEqual(2, len(checkpoints))
+        b = self.make_chain(100)
+        b.checkpoints = checkpoints
+        # chunk 2 has no checkpoint, and the random bits fail verification
+        self.assertEqual(1, b.import_snapshot(snapshot))
+        self.assertEqual(199, b.height())
+        self.assertEqual(self.raw_headers[150], bytes(b.read_raw_header(150)))
+        # a tampered chunk is rejected
+        b = self.make_chain(100)
+        b.checkpoints = checkpoints
+        with open(snapshot, 'r+b') as f:
+            f.seek(150 * blockchain.HDR_LEN + 108)
+            f.write(b'\xff')
+        self.assertEqual(0, b.import_snapshot(snapshot))
+        self.assertEqual(99, b.height())
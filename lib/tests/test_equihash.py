@@ -0,0 +1,49 @@
+import unittest
+
+from lib.equihash import Equihash, get_indices
+from lib.blockchain import get_header_size, get_equihash_params, BUBBLES_ACTIVATION_HEIGHT
+
+
+# a 48,5 solution for a zeroed header with nonce 1
+HEADER = bytes(108) + (1).to_bytes(32, 'little')
+SOLUTION = bytes.fromhex('038c87a5d0a6acd88e35ffdcaf1576e1cde8162dcfe8d52561c3b616d1a3fbc73c1eabec')
+
+
+def pack_indices(indices, bits, size):
+    v = 0
+    for i in indices:
+        v = (v << bits) | i
+    return v.to_bytes(size, 'big')
+
+
+class TestEquihash(unittest.TestCase):
+
+    def setUp(self):
+        self.e = Equihash(48, 5)
+
+    def test_valid_solution(self):
+        self.assertTrue(self.e.is_valid_solution(HEADER, SOLUTION))
+
+    def test_verify_header(self):
+        header = HEADER + bytes([len(SOLUTION)]) + SOLUTION
+        self.assertTrue(self.e.verify_header(header))
+        self.assertFalse(self.e.verify_header(header[:-1]))
+
+    def test_wrong_nonce(self):
+        header = bytes(108) + (2).to_bytes(32, 'little')
+        self.assertFalse(self.e.is_valid_solution(header, SOLUTION))
+
+    def test_unordered_indices(self):
+        indices = get_indices(48, 5, SOLUTION)
+        swapped = indices[16:] + indices[:16]
+        self.assertFalse(self.e.is_valid_solution(HEADER, pack_indices(swapped, 9, len(SOLUTION))))
+
+    def test_duplicate_indices(self):
+        indices = get_indices(48, 5, SOLUTION)
+        self.assertFalse(self.e.is_valid_solution(HEADER, pack_indices(indices[:16] * 2, 9, len(SOLUTION))))
+
+    def test_solution_sizes(self):
+        for height in [0, BUBBLES_ACTIVATION_HEIGHT - 1, BUBBLES_ACTIVATION_HEIGHT]:
+            e = Equihash(*get_equihash_params(height))
+            # header, 3 byte compact size and the solution
+            self.assertEqual(get_header_size(height), 140 + 3 + e.solution_size)
@@ -1,6 +1,12 @@
+import os
+import socket
+import ssl
+import tempfile
 import unittest
+from unittest import mock
 
 from lib import interface
+from lib import util
 
 
 class TestInterface(unittest.TestCase):
@@ -24,3 +30,134 @@ class TestInterface(unittest.TestCase):
         self.assertTrue(i.check_host_name(
             peercert={'subject': [('commonName', 'foo.bar.com')]},
             name='foo.bar.com'))
+
+    def test_batch_requests(self):
+        a, b = socket.socketpair()
+        i = interface.Interface('localhost:1:t', b)
+        i.pipe.set_timeout(0.1)
+        i.batch_size = 2
+        for n in range(3):
+            i.queue_request('server.version', [], n)
+        i.send_requests()
+        pipe = util.SocketPipe(a)
+        self.assertEqual([0, 1], [r['id'] for r in pipe.get()])
+        self.assertEqual(2, pipe.get()['id'])
+        pipe.send_all([[{'id': 1, 'result': 'b'}, {'id': 0, 'result': 'a'}], {'id': 2, 'result': 'c'}])
+        responses = i.get_responses()
+        self.assertEqual([(1, 'b'), (0, 'a'), (2, 'c')], [(req[2], resp['result']) for req, resp in responses])
+        self.assertFalse(i.unanswered_requests)
+        a.close()
+        i.close()
+
+    def test_batch_rejected(self):
+        a, b = socket.socketpair()
+        i = interface.Interface('localhost:1:t', b)
+        i.pipe.set_timeout(0.1)
+        for n in range(3):
+            i.queue_request('server.version', [], n)
+        i.send_requests()
+        pipe = util.SocketPipe(a)
+        batch = pipe.get()
+        self.assertEqual(3, len(batch))
+        self.assertTrue(all(r['jsonrpc'] == '2.0' for r in batch))
+        pipe.send({'id': None, 'error': {'code': -32600, 'message': 'invalid request'}})
+        self.assertEqual([], i.get_responses())
+        self.assertEqual(1, i.batch_size)
+        i.send_requests()
+        self.assertEqual([0, 1, 2], [pipe.get()['id'] for n in range(3)])
+        a.close()
+        i.close()
+
+    def test_error_after_batch_answered(self):
+        a, b = socket.socketpair()
+        i = interface.Interface('localhost:1:t', b)
+        i.pipe.set_timeout(0.1)
+        for n in range(3):
+            i.queue_request('server.version', [], n)
+        i.send_requests()
+        pipe = util.SocketPipe(a)
+        self.assertEqual(3, len(pipe.get()))
+        error = {'id': None, 'error': {'code': -32700, 'message': 'parse error'}}
+        pipe.send_all([[{'id': 0, 'result': 'a'}], error])
+        responses = i.get_responses()
+        self.assertEqual([0, None], [req[2] if req else None for req, resp in responses])
+        self.assertEqual(error, responses[1][1])
+        # the batch was accepted, so keep batching
+        self.assertEqual(50, i.batch_size)
+        self.assertEqual([1, 2], sorted(i.unanswered_requests))
+        self.assertEqual([], i.unsent_requests)
+        a.close()
+        i.close()
+
+    def test_request_window(self):
+        a, b = socket.socketpair()
+        i = interface.Interface('localhost:1:t', b)
+        window = i.window
+        for n in range(20):
+            i.on_response_time(0.01)
+        self.assertEqual(window + 20, i.window)
+        # slow responses halve the window
+        i.on_response_time(1)
+        self.assertEqual((window + 20) / 2, i.window)
+        self.assertEqual(i.MIN_TIMEOUT, i.request_timeout())
+        for n in range(50):
+            # a round trip later
+            i.last_decrease -= 60
+            i.on_response_time(5)
+        self.assertEqual(i.MIN_WINDOW, i.window)
+        # four times the round trip, plus some
+        self.assertTrue(20 <= i.request_timeout() < 25)
+        a.close()
+        i.close()
+
+    def test_request_window_methods(self):
+        a, b = socket.socketpair()
+        i = interface.Interface('localhost:1:t', b)
+        window = i.window
+        # pings and header chunks interleave, as during catch up; a
+        # chunk is slower than a ping without any queueing
+        for n in range(20):
+            i.on_response_time(0.01, 'server.ping')
+            i.last_decrease -= 60
+            i.on_response_time(2, 'blockchain.block.headers')
+        self.assertEqual(window + 40, i.window)
+        # a slow chunk still halves the window
+        i.on_response_time(10, 'blockchain.block.headers')
+        self.assertEqual((window + 40) / 2, i.window)
+        a.close()
+        i.close()
+
+    def test_tls_session_cache(self):
+        cache = interface.TLSSessionCache()
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'cert')
+            with open(path, 'w') as f:
+                f.write('cert')
+            create = lambda: interface.TcpConnection.get_ssl_context(ssl.CERT_NONE, None)
+            context = cache.get_context('localhost:1:s', path, create)
+            self.assertIs(context, cache.get_context('localhost:1:s', path, create))
+            cache.sessions['localhost:1:s'] = 'session'
+            self.assertEqual('session', cache.get_session('localhost:1:s'))
+            # a new pinned certificate needs a new context, and old
+            # sessions cannot be resumed with it
+            os.utime(path, (0, 0))
+            self.assertIsNot(context, cache.get_context('localhost:1:s', path, create))
+            self.assertIsNone(cache.get_session('localhost:1:s'))
+            # plain sockets have no session
+            a, b = socket.socketpair()
+            cache.save('localhost:1:s', a)
+            self.assertIsNone(cache.get_session('localhost:1:s'))
+            a.close()
+            b.close()
+
+    def test_tls_session_cache_disabled(self):
+        # before Python 3.6 sockets have no sessions to resume
+        cache = interface.TLSSessionCache(enabled=False)
+        create = lambda: interface.TcpConnection.get_ssl_context(ssl.CERT_NONE, None)
+        context = cache.get_context('localhost:1:s', None, create)
+        self.assertIs(context, cache.get_context('localhost:1:s', None, create))
+        cache.sessions['localhost:1:s'] = 'session'
+        self.assertIsNone(cache.get_session('localhost:1:s'))
+        s = mock.Mock(session='other', context=context)
+        cache.save('localhost:1:s', s)
+        self.assertEqual('session', cache.sessions['localhost:1:s'])
@@ -0,0 +1,65 @@
+import unittest
+import urllib.request
+
+from lib.network_stats import NetworkStats, MetricsServer, to_prometheus
+
+
+class MockNetwork(object):
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def get_network_stats(self):
+        stats = self.stats.get_stats()
+        stats['interfaces'] = {'a:50002:s': {'bytes_sent': 10, 'bytes_received': 20}}
+        stats['queues'] = {'pending_sends': 1, 'unsent_requests': 2, 'unanswered_requests': 3}
+        return stats
+
+
+class TestNetworkStats(unittest.TestCase):
+
+    def setUp(self):
+        super(TestNetworkStats, self).setUp()
+        self.stats = NetworkStats()
+        for method in ['server.version', 'server.version', 'blockchain.transaction.get']:
+            self.stats.add_request(method)
+        self.stats.add_latency('server.version', 0.03)
+        self.stats.add_latency('server.version', 20)
+        self.stats.add_step('run_jobs', 0.5)
+        self.stats.add_step('run_jobs', 0.25)
+
+    def test_get_stats(self):
+        stats = self.stats.get_stats()
+        r = stats['requests']['server.version']
+        self.assertEqual(2, r['sent'])
+        self.assertEqual(2, r['responses'])
+        self.assertAlmostEqual(20.03, r['latency_sum'])
+        buckets = dict(r['latency_buckets'])
+        self.assertEqual(0, buckets['0.01'])
+        self.assertEqual(1, buckets['0.05'])
+        self.assertEqual(1, buckets['10'])
+        self.assertEqual(2, buckets['+Inf'])
+        self.assertEqual(0, stats['requests']['blockchain.transaction.get']['responses'])
+        self.assertEqual({'calls': 2, 'seconds': 0.75, 'max_seconds': 0.5}, stats['loop']['run_jobs'])
+
+    def test_prometheus(self):
+        text = to_prometheus(MockNetwork(self.stats).get_network_stats())
+        lines = text.splitlines()
+        self.assertIn('electrum_requests_total{method="server.version"} 2', lines)
+        self.assertIn('electrum_request_latency_seconds_bucket{method="server.version",le="+Inf"} 2', lines)
+        self.assertIn('electrum_request_latency_seconds_count{method="server.version"} 2', lines)
+        self.assertIn('electrum_interface_received_bytes_total{server="a:50002:s"} 20', lines)
+        self.assertIn('electrum_queue_depth{queue="unanswered_requests"} 3', lines)
+        self.assertIn('electrum_loop_calls_total{step="run_jobs"} 2', lines)
+        self.assertIn('# TYPE electrum_request_latency_seconds histogram', lines)
+
+    def test_metrics_server(self):
+        server = MetricsServer(MockNetwork(self.stats), '127.0.0.1', 0)
+        server.start()
+        try:
+            host, port = server.server.server_address
+            with urllib.request.urlopen('http://%s:%d/metrics' % (host, port)) as f:
+                text = f.read().decode('utf8')
+            self.assertIn('electrum_queue_depth{queue="pending_sends"} 1', text)
+        finally:
+            server.stop()
@@ -0,0 +1,84 @@
+import shutil
+import tempfile
+import unittest
+
+from lib.blockchain import BlockHeader, HDR_LEN
+from lib.response_cache import ResponseCache
+
+
+class MockBlockchain(object):
+
+    def __init__(self, height):
+        self.headers = {h: BlockHeader(bytes([h % 256]) * HDR_LEN, h) for h in range(height + 1)}
+
+    def read_header(self, height):
+        return self.headers.get(height)
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        super(TestResponseCache, self).setUp()
+        self.electrum_dir = tempfile.mkdtemp()
+        self.blockchain = MockBlockchain(100)
+
+    def tearDown(self):
+        super(TestResponseCache, self).tearDown()
+        shutil.rmtree(self.electrum_dir)
+
+    def test_immutable_responses(self):
+        cache = ResponseCache(10)
+        cache.put('blockchain.transaction.get', ['aa'], 'raw', self.blockchain, 100)
+        self.assertEqual('raw', cache.get('blockchain.transaction.get', ['aa'], self.blockchain))
+        # verbose transactions, recent blocks and other methods are not cached
+        cache.put('blockchain.transaction.get', ['aa', True], {}, self.blockchain, 100)
+        cache.put('blockchain.transaction.get_merkle', ['bb', 98], {'block_height': 98}, self.blockchain, 100)
+        cache.put('blockchain.scripthash.get_history', ['cc'], [], self.blockchain, 100)
+        self.assertEqual(1, len(cache.entries))
+        cache.put('blockchain.transaction.get_merkle', ['bb', 90], {'block_height': 90, 'pos': 1}, self.blockchain, 100)
+        merkle = cache.get('blockchain.transaction.get_merkle', ['bb', 90], self.blockchain)
+        self.assertEqual({'block_height': 90, 'pos': 1}, merkle)
+        # callers get copies
+        merkle['pos'] = 2
+        self.assertEqual(1, cache.get('blockchain.transaction.get_merkle', ['bb', 90], self.blockchain)['pos'])
+
+    def test_lru(self):
+        cache = ResponseCache(2)
+        for txid in ['aa', 'bb']:
+            cache.put('blockchain.transaction.get', [txid], txid, self.blockchain, 100)
+        cache.get('blockchain.transaction.get', ['aa'], self.blockchain)
+        cache.put('blockchain.transaction.get', ['cc'], 'cc', self.blockchain, 100)
+        self.assertIsNone(cache.get('blockchain.transaction.get', ['bb'], self.blockchain))
+        self.assertEqual('aa', cache.get('blockchain.transaction.get', ['aa'], self.blockchain))
+
+    def test_reorg(self):
+        cache = ResponseCache(10)
+        for height in [50, 90]:
+            cache.put('blockchain.block.header', [height], 'header', self.blockchain, 100)
+        cache.put('blockchain.transaction.get', ['aa'], 'raw', self.blockchain, 100)
+        fork = MockBlockchain(100)
+        fork.headers[90] = BlockHeader(bytes([255]) * HDR_LEN, 90)
+        cache.invalidate(fork)
+        self.assertEqual(2, len(cache.entries))
+        self.assertEqual('header', cache.get('blockchain.block.header', [50], fork))
+        # also checked on lookup
+        fork.headers[50] = None
+        self.assertIsNone(cache.get('blockchain.block.header', [50], fork))
+        self.assertEqual('raw', cache.get('blockchain.transaction.get', ['aa'], fork))
+
+    def test_save(self):
+        cache = ResponseCache(10, self.electrum_dir)
+        cache.put('blockchain.transaction.get_merkle', ['bb', 90], {'block_height': 90}, self.blockchain, 100)
+        cache.save()
+        cache = ResponseCache(10, self.electrum_dir)
+        self.assertEqual({'block_height': 90}, cache.get('blockchain.transaction.get_merkle', ['bb', 90], self.blockchain))
+
+    def test_stats(self):
+        cache = ResponseCache(10)
+        cache.put('blockchain.transaction.get', ['aa'], 'raw', self.blockchain, 100)
+        cache.get('blockchain.transaction.get', ['aa'], self.blockchain)
+        cache.get('blockchain.transaction.get', ['bb'], self.blockchain)
+        # methods that are never cached do not count as misses
+        cache.get('blockchain.estimatefee', [2], self.blockchain)
+        cache.get('blockchain.transaction.broadcast', ['00'], self.blockchain)
+        self.assertEqual({'size': 1, 'hits': 1, 'misses': 1}, cache.get_stats())
@@ -0,0 +1,38 @@
+import shutil
+import tempfile
+import unittest
+
+from lib.server_scores import ServerScores
+
+
+class TestServerScores(unittest.TestCase):
+
+    def setUp(self):
+        super(TestServerScores, self).setUp()
+        self.electrum_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(TestServerScores, self).tearDown()
+        shutil.rmtree(self.electrum_dir)
+
+    def test_best(self):
+        scores = ServerScores(self.electrum_dir)
+        for i in range(20):
+            scores.add_latency('fast:50002:s', 0.05)
+            scores.add_latency('slow:50002:s', 0.8)
+        self.assertEqual('fast:50002:s', scores.best(['fast:50002:s', 'slow:50002:s']))
+        # errors and lag count against a server
+        for i in range(20):
+            scores.add_error('fast:50002:s')
+        self.assertEqual('slow:50002:s', scores.best(['fast:50002:s', 'slow:50002:s']))
+        scores.set_lag('slow:50002:s', 3)
+        self.assertEqual('fast:50002:s', scores.best(['fast:50002:s', 'slow:50002:s']))
+        self.assertIsNone(scores.best([]))
+
+    def test_persistence(self):
+        scores = ServerScores(self.electrum_dir)
+        scores.add_latency('a:50002:s', 0.1)
+        scores.add_error('b:50002:s')
+        scores.save()
+        loaded = ServerScores(self.electrum_dir)
+        self.assertEqual(scores.get_stats(), loaded.get_stats())
@@ -0,0 +1,45 @@
+import functools
+import unittest
+
+from lib.subscriptions import SubscriptionRegistry
+
+
+class TestSubscriptionRegistry(unittest.TestCase):
+
+    def test_add_remove(self):
+        r = SubscriptionRegistry()
+        a, b = [], []
+        r.add('k1', a.append)
+        r.add('k1', b.append)
+        r.add('k2', a.append)
+        # subscribing twice keeps one callback
+        r.add('k2', a.append)
+        self.assertEqual([a.append, b.append], r.get('k1'))
+        self.assertEqual([a.append], r.get('k2'))
+        self.assertEqual(['k2'], r.remove(a.append))
+        self.assertEqual([b.append], r.get('k1'))
+        self.assertNotIn('k2', r)
+        self.assertEqual([], r.get('k2'))
+        self.assertEqual(['k1'], r.remove(b.append))
+        self.assertEqual(0, len(r))
+        self.assertEqual([], r.remove(b.append))
+
+    def test_wrapped_callbacks(self):
+        r = SubscriptionRegistry()
+        received = []
+
+        def wrap(callback, tag):
+            @functools.wraps(callback)
+            def wrapper(x):
+                callback((tag, x))
+            return wrapper
+
+        r.add('k1', wrap(received.append, 1))
+        r.add('k2', wrap(received.append, 2))
+        # a newer wrapper of the same callback replaces the old one
+        r.add('k1', wrap(received.append, 3))
+        for callback in r.get('k1') + r.get('k2'):
+            callback('x')
+        self.assertEqual([(3, 'x'), (2, 'x')], received)
+        self.assertEqual({'k1', 'k2'}, set(r.remove(received.append)))
+        self.assertEqual(0, len(r))
@@ -1,5 +1,8 @@
+import json
+import socket
+import threading
 import unittest
-from lib.util import format_satoshis, parse_URI
+from lib.util import format_satoshis, parse_URI, SocketPipe
 
 class TestUtil(unittest.TestCase):
 
@@ -68,3 +71,20 @@ class TestUtil(unittest.TestCase):
     def test_parse_URI_parameter_polution(self):
         self.assertRaises(Exception, parse_URI, 'zclassic:t1NdvKvSnnBoJ7D9nfJSX5kK7GEGNs1bY4S?amount=0.0003&label=test&amount=30.0')
 
+
+    def test_socket_pipe_framing(self):
+        a, b = socket.socketpair()
+        pipe = SocketPipe(b)
+        pipe.set_timeout(10)
+        messages = [{'id': i, 'result': 'ab' * 40000 * i} for i in range(3)]
+        data = b''.join((json.dumps(m) + '\n').encode('utf8') for m in messages)
+        def send():
+            # a bad line is skipped
+            a.sendall(b'{"id"\n' + data)
+            a.close()
+        sender = threading.Thread(target=send)
+        sender.start()
+        self.assertEqual(messages, [pipe.get(), pipe.get(), pipe.get()])
+        self.assertIsNone(pipe.get())
+        sender.join()
+        b.close()
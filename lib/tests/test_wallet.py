@@ -4,9 +4,14 @@ import sys
 import unittest
 import os
 import json
+import time
 
 from io import StringIO
+from lib import bitcoin
+from lib.bitcoin import TYPE_ADDRESS
 from lib.storage import WalletStorage, FINAL_SEED_VERSION
+from lib.transaction import Transaction
+from lib.wallet import Imported_Wallet
 
 
 class FakeSynchronizer(object):
@@ -67,3 +72,164 @@ class TestWalletStorage(WalletTestCase):
         with open(self.wallet_path, "r") as f:
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
+
+
+def make_key(i):
+    privkey = bytes([i]) * 32
+    pubkey = bitcoin.public_key_from_private_key(privkey, True)
+    return privkey, pubkey, bitcoin.pubkey_to_address('p2pkh', pubkey)
+
+
+def make_tx(key, prevouts, outputs):
+    """A transaction signed by key, spending (txid, n, value) prevouts"""
+    privkey, pubkey, address = key
+    inputs = [{'type': 'p2pkh', 'address': address, 'prevout_hash': txid,
+               'prevout_n': n, 'value': value, 'pubkeys': [pubkey],
+               'x_pubkeys': [pubkey], 'signatures': [None], 'num_sig': 1}
+              for txid, n, value in prevouts]
+    tx = Transaction.from_io(inputs, [(TYPE_ADDRESS, a, v) for a, v in outputs])
+    tx.sign({pubkey: (privkey, True)})
+    return Transaction(str(tx))
+
+
+class TestWalletTransactions(WalletTestCase):
+
+    def setUp(self):
+        super(TestWalletTransactions, self).setUp()
+        self.wallet = Imported_Wallet(WalletStorage(self.wallet_path))
+        self.keys = [make_key(i) for i in range(1, 4)]
+        for key in self.keys:
+            self.wallet.import_address(key[2])
+        self.other = make_key(9)
+        self.fund = make_tx(self.other, [('aa' * 32, 0, 100000)],
+                            [(self.keys[0][2], 50000), (self.keys[1][2], 30000)])
+        self.spend = make_tx(self.keys[0], [(self.fund.txid(), 0, 50000)],
+                             [(self.other[2], 10000), (self.keys[2][2], 39000)])
+
+    def add(self, tx, height):
+        self.wallet.add_unverified_tx(tx.txid(), height)
+        self.wallet.add_transaction(tx.txid(), tx)
+
+    def get_utxos(self):
+        return sorted((x['address'], x['value'], x['height']) for x in self.wallet.get_utxos())
+
+    def test_utxos(self):
+        self.add(self.fund, 100)
+        self.assertEqual(sorted([(self.keys[0][2], 50000, 100), (self.keys[1][2], 30000, 100)]),
+                         self.get_utxos())
+        self.add(self.spend, 0)
+        self.assertEqual(sorted([(self.keys[1][2], 30000, 100), (self.keys[2][2], 39000, 0)]),
+                         self.get_utxos())
+        self.assertEqual({}, self.wallet.get_addr_utxo(self.keys[0][2]))
+        # heights are those of the funding transactions
+        self.wallet.add_unverified_tx(self.spend.txid(), 101)
+        self.assertIn((self.keys[2][2], 39000, 101), self.get_utxos())
+        # removing the spending transaction gives the coin back
+        self.wallet.remove_transaction(self.spend.txid())
+        self.assertEqual(sorted([(self.keys[0][2], 50000, 100), (self.keys[1][2], 30000, 100)]),
+                         self.get_utxos())
+
+    def test_utxos_out_of_order(self):
+        # the spend arrives before the transaction it spends
+        self.add(self.spend, 0)
+        self.assertEqual([(self.keys[2][2], 39000, 0)], self.get_utxos())
+        self.add(self.fund, 100)
+        self.assertEqual(sorted([(self.keys[1][2], 30000, 100), (self.keys[2][2], 39000, 0)]),
+                         self.get_utxos())
+        # the index is rebuilt the same when the wallet is loaded
+        self.wallet.save_transactions(write=True)
+        wallet = Imported_Wallet(WalletStorage(self.wallet_path))
+        self.assertEqual(self.wallet._utxos, wallet._utxos)
+        self.assertEqual(self.wallet._spent, wallet._spent)
+
+    def test_balance(self):
+        self.add(self.fund, 100)
+        self.assertEqual((80000, 0, 0), self.wallet.get_balance())
+        self.add(self.spend, 0)
+        # unconfirmed spends are deducted from the unconfirmed balance
+        self.assertEqual((80000, -11000, 0), self.wallet.get_balance())
+        self.assertEqual((0, 39000, 0), self.wallet.get_addr_balance(self.keys[2][2]))
+        self.assertEqual((50000, -50000, 0), self.wallet.get_addr_balance(self.keys[0][2]))
+        self.wallet.set_frozen_state([self.keys[1][2]], True)
+        self.assertEqual((30000, 0, 0), self.wallet.get_frozen_balance())
+        # the cached balances follow height changes and removals
+        self.wallet.add_unverified_tx(self.spend.txid(), 101)
+        self.assertEqual((69000, 0, 0), self.wallet.get_balance())
+        self.wallet.remove_transaction(self.spend.txid())
+        self.assertEqual((80000, 0, 0), self.wallet.get_balance())
+        self.assertEqual((0, 0, 0), self.wallet.get_addr_balance(self.keys[2][2]))
+
+    def test_history(self):
+        self.add(self.spend, 0)
+        self.add(self.fund, 100)
+        self.assertEqual([(self.fund.txid(), 100, 0, None, 80000, 80000),
+                          (self.spend.txid(), 0, 0, None, -11000, 69000)],
+                         self.wallet.get_history())
+        # the rows follow height changes
+        self.wallet.add_unverified_tx(self.fund.txid(), 0)
+        self.wallet.add_unverified_tx(self.spend.txid(), 101)
+        self.assertEqual([self.spend.txid(), self.fund.txid()],
+                         [row[0] for row in self.wallet.get_history()])
+        # unconfirmed transactions are dated now
+        h = self.wallet.get_full_history(from_timestamp=time.time() - 60)
+        self.assertEqual(2, len(h['transactions']))
+        h = self.wallet.get_full_history(to_timestamp=time.time() - 60)
+        self.assertEqual([], h['transactions'])
+        self.wallet.remove_transaction(self.spend.txid())
+        self.assertEqual([(self.fund.txid(), 0, 0, None, 80000, 80000)],
+                         self.wallet.get_history())
+
+    def test_history_pruned(self):
+        # the spend arrives first: its delta is unknown until the
+        # transaction it spends does
+        self.add(self.spend, 0)
+        self.assertEqual([(self.spend.txid(), 0, 0, None, None, 39000)], self.wallet.get_history())
+        self.add(self.fund, 100)
+        self.assertEqual(-11000, self.wallet.get_history()[1][4])
+        # transactions of the server history that are not downloaded yet
+        # are not listed, the same as with an explicit domain
+        self.wallet.receive_history_callback(self.keys[1][2], [(self.fund.txid(), 100), ('bb' * 32, 101)], {})
+        self.assertEqual(self.wallet.get_history(self.wallet.get_addresses()), self.wallet.get_history())
+        self.assertEqual([self.fund.txid(), self.spend.txid()], [row[0] for row in self.wallet.get_history()])
+
+    def test_iter_history(self):
+        self.add(self.fund, 100)
+        self.add(self.spend, 0)
+        history = self.wallet.get_history()
+        self.assertEqual(history[::-1], list(self.wallet.iter_history()))
+        # the next page starts after the cursor
+        self.assertEqual(history[:1], list(self.wallet.iter_history(before=self.spend.txid())))
+        self.assertEqual([], list(self.wallet.iter_history(before=self.fund.txid())))
+        self.assertRaises(Exception, list, self.wallet.iter_history(before='00' * 32))
+
+    def test_remove_funding_transaction(self):
+        self.add(self.fund, 100)
+        self.add(self.spend, 0)
+        ser = self.fund.txid() + ':0'
+        self.assertEqual({self.spend.txid()}, self.wallet.get_depending_transactions(self.fund.txid()))
+        self.assertEqual(set(), self.wallet.get_depending_transactions(self.spend.txid()))
+        # the spend of the removed transaction becomes pruned
+        self.wallet.remove_transaction(self.fund.txid())
+        self.assertEqual({ser: self.spend.txid()}, self.wallet.pruned_txo)
+        self.assertEqual({}, self.wallet.txi[self.spend.txid()])
+        self.assertEqual({self.spend.txid()}, self.wallet.get_depending_transactions(self.fund.txid()))
+        # and is resolved again when it comes back
+        self.add(self.fund, 100)
+        self.assertEqual({}, self.wallet.pruned_txo)
+        self.assertEqual({self.spend.txid()}, self.wallet.get_depending_transactions(self.fund.txid()))
+
+    def test_depending_transactions_not_mine(self):
+        # we pay someone, who pays us back from that output
+        payment = make_tx(self.keys[1], [(self.fund.txid(), 1, 30000)],
+                          [(self.other[2], 20000), (self.keys[1][2], 9000)])
+        refund = make_tx(self.other, [(payment.txid(), 0, 20000)],
+                         [(self.keys[2][2], 19000)])
+        self.add(self.fund, 100)
+        self.add(payment, 101)
+        self.add(refund, 0)
+        self.assertEqual({payment.txid(), refund.txid()},
+                         self.wallet.get_depending_transactions(self.fund.txid()))
+        self.assertEqual({refund.txid()}, self.wallet.get_depending_transactions(payment.txid()))
+        # the index follows removals
+        self.wallet.remove_transaction(refund.txid())
+        self.assertEqual(set(), self.wallet.get_depending_transactions(payment.txid()))
@@ -658,11 +658,20 @@ import time
 
 
 class SocketPipe:
+
+    RECV_SIZE = 65536
+
     def __init__(self, socket):
         self.socket = socket
-        self.message = b''
+        # received bytes not yet returned as messages
+        self.message = bytearray()
+        # no newline in self.message before this offset
+        self.scan_offset = 0
+        self.recv_buffer = bytearray(self.RECV_SIZE)
         self.set_timeout(0.1)
         self.recv_time = time.time()
+        self.bytes_sent = 0
+        self.bytes_received = 0
 
     def set_timeout(self, t):
         self.socket.settimeout(t)
@@ -670,13 +679,31 @@ class SocketPipe:
     def idle_time(self):
         return time.time() - self.recv_time
 
+    def parse_message(self):
+        '''Pop the next JSON message off the receive buffer'''
+        while True:
+            n = self.message.find(b'\n', self.scan_offset)
+            if n == -1:
+                self.scan_offset = len(self.message)
+                return None
+            try:
+                with memoryview(self.message) as view:
+                    line = str(view[:n], 'utf8')
+                return json.loads(line)
+            except:
+                # skip it, like parse_json
+                pass
+            finally:
+                del self.message[:n+1]
+                self.scan_offset = 0
+
     def get(self):
         while True:
-            response, self.message = parse_json(self.message)
+            response = self.parse_message()
             if response is not None:
                 return response
             try:
-                data = self.socket.recv(1024)
+                n = self.socket.recv_into(self.recv_buffer)
             except socket.timeout:
                 raise timeout
             except ssl.SSLError:
@@ -690,14 +717,16 @@ class SocketPipe:
                     raise timeout
                 else:
                     print_error("pipe: socket error", err)
-                    data = b''
+                    n = 0
             except:
                 traceback.print_exc(file=sys.stderr)
-                data = b''
+                n = 0
 
-            if not data:  # Connection closed remotely
+            if not n:  # Connection closed remotely
                 return None
-            self.message += data
+            with memoryview(self.recv_buffer) as view:
+                self.message += view[:n]
+            self.bytes_received += n
             self.recv_time = time.time()
 
     def send(self, request):
@@ -713,6 +742,7 @@ class SocketPipe:
         while out:
             try:
                 sent = self.socket.send(out)
+                self.bytes_sent += sent
                 out = out[sent:]
             except ssl.SSLError as e:
                 print_error("SSLError:", e)
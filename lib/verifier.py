@@ -48,8 +48,7 @@ class SPV(ThreadJob):
         for tx_hash, tx_height in unverified.items():
             # do not request merkle branch before headers are available
             if (tx_height > 0) and (tx_height <= lh):
-                header = blockchain.read_header(tx_height)
-                if header is None:
+                if blockchain.get_timestamp(tx_height) is None:
                     index = tx_height // CHUNK_LEN
                     if index < len(blockchain.checkpoints):
                         self.network.request_chunk(interface, index)
@@ -79,24 +78,25 @@ class SPV(ThreadJob):
         tx_height = merkle.get('block_height')
         pos = merkle.get('pos')
         merkle_root = self.hash_merkle_root(merkle['merkle'], tx_hash, pos)
-        header = self.network.blockchain().read_header(tx_height)
+        blockchain = self.network.blockchain()
+        header_merkle_root = blockchain.get_merkle_root(tx_height)
         # FIXME: if verification fails below,
         # we should make a fresh connection to a server to
         # recover from this, as this TX will now never verify
-        if not header:
+        if not header_merkle_root:
             self.print_error(
                 "merkle verification failed for {} (missing header {})"
                 .format(tx_hash, tx_height))
             return
-        if header.get('merkle_root') != merkle_root:
+        if header_merkle_root != merkle_root:
             self.print_error(
                 "merkle verification failed for {} (merkle root mismatch {} != {})"
-                .format(tx_hash, header.get('merkle_root'), merkle_root))
+                .format(tx_hash, header_merkle_root, merkle_root))
             return
         # we passed all the tests
         self.merkle_roots[tx_hash] = merkle_root
         self.print_error("verified %s" % tx_hash)
-        self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos))
+        self.wallet.add_verified_tx(tx_hash, (tx_height, blockchain.get_timestamp(tx_height), pos))
 
     @classmethod
     def hash_merkle_root(cls, merkle_s, target_hash, pos):
@@ -38,6 +38,7 @@ import traceback
 from functools import partial
 from collections import defaultdict
 from numbers import Number
+from bisect import bisect_left, bisect_right
 from decimal import Decimal
 import itertools
 
@@ -77,6 +78,9 @@ TX_HEIGHT_LOCAL = -2
 TX_HEIGHT_UNCONF_PARENT = -1
 TX_HEIGHT_UNCONFIRMED = 0
 
+# rows read at once by Abstract_Wallet.iter_history
+HISTORY_CHUNK_SIZE = 100
+
 
 def relayfee(network):
     from .simple_config import FEERATE_DEFAULT_RELAY
@@ -253,6 +257,7 @@ class Abstract_Wallet(PrintError):
         self.pruned_txo = self.storage.get('pruned_txo', {})
         tx_list = self.storage.get('transactions', {})
         self.transactions = {}
+        self._children = None
         for tx_hash, raw in tx_list.items():
             tx = Transaction(raw)
             self.transactions[tx_hash] = tx
@@ -260,10 +265,69 @@ class Abstract_Wallet(PrintError):
                     and (tx_hash not in self.pruned_txo.values()):
                 self.print_error("removing unreferenced tx", tx_hash)
                 self.transactions.pop(tx_hash)
+        self.reset_balance_cache()
+        self.reset_history_cache()
+        self.build_utxo_index()
+
+    @profiler
+    def build_utxo_index(self):
+        '''Index the coins of each address that are not spent by a wallet
+        transaction.  Kept in step with txi and txo by add_transaction and
+        remove_transaction.'''
+        with self.transaction_lock:
+            self._utxos = {}  # address -> {ser: (txid, n, value, is_coinbase)}
+            self._spent = {}  # address -> set(ser) spent by wallet transactions
+            for txid, d in self.txi.items():
+                for addr, l in d.items():
+                    for ser, v in l:
+                        self._add_spend_to_utxo_index(addr, ser)
+            for txid, d in self.txo.items():
+                for addr, l in d.items():
+                    for n, v, is_cb in l:
+                        self._add_coin_to_utxo_index(addr, txid, n, v, is_cb)
+
+    def _add_coin_to_utxo_index(self, addr, txid, n, v, is_cb):
+        self._invalidate_balance(addr)
+        ser = txid + ':%d'%n
+        if ser not in self._spent.get(addr, ()):
+            self._utxos.setdefault(addr, {})[ser] = (txid, n, v, is_cb)
+
+    def _remove_coin_from_utxo_index(self, addr, txid, n):
+        self._invalidate_balance(addr)
+        coins = self._utxos.get(addr)
+        if coins is not None:
+            coins.pop(txid + ':%d'%n, None)
+            if not coins:
+                self._utxos.pop(addr)
+
+    def _add_spend_to_utxo_index(self, addr, ser):
+        self._invalidate_balance(addr)
+        self._spent.setdefault(addr, set()).add(ser)
+        coins = self._utxos.get(addr)
+        if coins is not None:
+            coins.pop(ser, None)
+            if not coins:
+                self._utxos.pop(addr)
+
+    def _remove_spend_from_utxo_index(self, addr, ser):
+        spent = self._spent.get(addr)
+        if spent is None or ser not in spent:
+            return
+        spent.remove(ser)
+        if not spent:
+            self._spent.pop(addr)
+        self._invalidate_balance(addr)
+        # the coin is unspent again, if we have it
+        prevout_hash, prevout_n = ser.split(':')
+        for n, v, is_cb in self.txo.get(prevout_hash, {}).get(addr, []):
+            if n == int(prevout_n):
+                self._add_coin_to_utxo_index(addr, prevout_hash, n, v, is_cb)
 
     @profiler
     def load_local_history(self):
         self._history_local = {}  # address -> set(txid)
+        self._local_history_addrs = {}  # txid -> set(address)
+        self.reset_history_cache()
         for txid in itertools.chain(self.txi, self.txo):
             self._add_tx_to_local_history(txid)
 
@@ -300,15 +364,63 @@ class Abstract_Wallet(PrintError):
                 self.history = {}
                 self.verified_tx = {}
                 self.transactions = {}
+                self.reset_balance_cache()
+                self.build_utxo_index()
+                self.build_spent_outpoints()
+                self.load_local_history()
                 self.save_transactions()
 
     @profiler
     def build_spent_outpoints(self):
         self.spent_outpoints = {}
+        # spends tracked in txi and pruned_txo, by prevout txid:
+        # {ser: (txid, addr)}, addr is None while ser is in pruned_txo
+        self._spends_by_prevout = {}
+        # the serialized outpoints spent by each txid
+        self._spends_by_tx = {}
         for txid, items in self.txi.items():
             for addr, l in items.items():
                 for ser, v in l:
                     self.spent_outpoints[ser] = txid
+                    self._add_spend(txid, ser, addr)
+        for ser, txid in self.pruned_txo.items():
+            self._add_spend(txid, ser, None)
+        # the wallet transactions spending any output of a txid, mine
+        # or not.  Built when first needed, as it deserializes all
+        # transactions
+        self._children = None
+
+    def _add_children(self, tx_hash, tx):
+        for txin in tx.inputs():
+            if txin['type'] != 'coinbase':
+                self._children.setdefault(txin['prevout_hash'], set()).add(tx_hash)
+
+    def _remove_children(self, tx_hash, tx):
+        for txin in tx.inputs():
+            if txin['type'] != 'coinbase':
+                children = self._children.get(txin['prevout_hash'])
+                if children is not None:
+                    children.discard(tx_hash)
+                    if not children:
+                        self._children.pop(txin['prevout_hash'])
+
+    def _add_spend(self, tx_hash, ser, addr):
+        prevout_hash = ser.split(':')[0]
+        self._spends_by_prevout.setdefault(prevout_hash, {})[ser] = tx_hash, addr
+        self._spends_by_tx.setdefault(tx_hash, set()).add(ser)
+
+    def _remove_spend(self, tx_hash, ser):
+        prevout_hash = ser.split(':')[0]
+        spends = self._spends_by_prevout.get(prevout_hash, {})
+        if ser in spends and spends[ser][0] == tx_hash:
+            spends.pop(ser)
+            if not spends:
+                self._spends_by_prevout.pop(prevout_hash)
+        sers = self._spends_by_tx.get(tx_hash)
+        if sers is not None:
+            sers.discard(ser)
+            if not sers:
+                self._spends_by_tx.pop(tx_hash)
 
     @profiler
     def check_history(self):
@@ -438,6 +550,7 @@ class Abstract_Wallet(PrintError):
         return [self.get_public_key(address)]
 
     def add_unverified_tx(self, tx_hash, tx_height):
+        old_height = self.get_tx_height(tx_hash)[0]
         if tx_height in (TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT) \
                 and tx_hash in self.verified_tx:
             self.verified_tx.pop(tx_hash)
@@ -447,6 +560,8 @@ class Abstract_Wallet(PrintError):
         # tx will be verified only if height > 0
         if tx_hash not in self.verified_tx:
             self.unverified_tx[tx_hash] = tx_height
+        if self.get_tx_height(tx_hash)[0] != old_height:
+            self._invalidate_tx(tx_hash)
 
     def add_verified_tx(self, tx_hash, info):
         # Remove from the unverified map and add to the verified map and
@@ -454,6 +569,7 @@ class Abstract_Wallet(PrintError):
         with self.lock:
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
         height, conf, timestamp = self.get_tx_height(tx_hash)
+        self._invalidate_tx(tx_hash)
         self.network.trigger_callback('verified', tx_hash, height, conf, timestamp)
 
     def get_unverified_txs(self):
@@ -467,10 +583,10 @@ class Abstract_Wallet(PrintError):
             for tx_hash, item in list(self.verified_tx.items()):
                 tx_height, timestamp, pos = item
                 if tx_height >= height:
-                    header = blockchain.read_header(tx_height)
                     # fixme: use block hash, not timestamp
-                    if not header or header.get('timestamp') != timestamp:
+                    if blockchain.get_timestamp(tx_height) != timestamp:
                         self.verified_tx.pop(tx_hash, None)
+                        self._invalidate_tx(tx_hash)
                         txs.add(tx_hash)
         return txs
 
@@ -653,22 +769,21 @@ class Abstract_Wallet(PrintError):
         return received, sent
 
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
-        out = {}
-        for txo, v in coins.items():
-            tx_height, value, is_cb = v
-            prevout_hash, prevout_n = txo.split(':')
-            x = {
-                'address':address,
-                'value':value,
-                'prevout_n':int(prevout_n),
-                'prevout_hash':prevout_hash,
-                'height':tx_height,
-                'coinbase':is_cb
-            }
-            out[txo] = x
+        # we need self.transaction_lock but get_tx_height will take self.lock
+        # so we need to take that too here, to enforce order of locks
+        with self.lock, self.transaction_lock:
+            coins = list(self._utxos.get(address, {}).items())
+            out = {}
+            for txo, (prevout_hash, prevout_n, value, is_cb) in coins:
+                x = {
+                    'address':address,
+                    'value':value,
+                    'prevout_n':prevout_n,
+                    'prevout_hash':prevout_hash,
+                    'height':self.get_tx_height(prevout_hash)[0],
+                    'coinbase':is_cb
+                }
+                out[txo] = x
         return out
 
     # return the total amount ever received by an address
@@ -676,12 +791,51 @@ class Abstract_Wallet(PrintError):
         received, sent = self.get_addr_io(address)
         return sum([v for height, v, is_cb in received.values()])
 
-    # return the balance of a bitcoin address: confirmed and matured, unconfirmed, unmatured
-    def get_addr_balance(self, address):
+    def reset_balance_cache(self):
+        self._balance_lock = threading.RLock()
+        # address -> (confirmed, unconfirmed, unmatured, low, high), valid
+        # while low <= local height < high, see _compute_addr_balance
+        self._balances = {}
+        # addresses to recompute
+        self._balance_dirty = set()
+        # sum of the entries of self._balances
+        self._balance_total = [0, 0, 0]
+        # addresses with coinbase coins, and the local heights between
+        # which none of their entries expire
+        self._balance_coinbase = set()
+        self._balance_low, self._balance_high = float('-inf'), float('inf')
+        # incremented on each change, see get_frozen_balance
+        self._balance_version = 0
+        self._frozen_balance = None
+
+    def _invalidate_balance(self, addr):
+        with self._balance_lock:
+            entry = self._balances.pop(addr, None)
+            if entry is not None:
+                for i in range(3):
+                    self._balance_total[i] -= entry[i]
+                self._balance_coinbase.discard(addr)
+            self._balance_dirty.add(addr)
+            self._balance_version += 1
+
+    def _invalidate_tx(self, tx_hash):
+        '''The height or the position of tx_hash changed'''
+        with self.transaction_lock:
+            self._history_dirty.add(tx_hash)
+            addrs = set(itertools.chain(self.txi.get(tx_hash, {}), self.txo.get(tx_hash, {})))
+        for addr in addrs:
+            self._invalidate_balance(addr)
+
+    def _compute_addr_balance(self, address, local_height):
         received, sent = self.get_addr_io(address)
         c = u = x = 0
-        local_height = self.get_local_height()
+        low, high = float('-inf'), float('inf')
         for txo, (tx_height, v, is_cb) in received.items():
+            if is_cb:
+                if tx_height + COINBASE_MATURITY > local_height:
+                    high = min(high, tx_height + COINBASE_MATURITY)
+                else:
+                    low = max(low, tx_height + COINBASE_MATURITY)
             if is_cb and tx_height + COINBASE_MATURITY > local_height:
                 x += v
             elif tx_height > 0:
@@ -693,7 +847,54 @@ class Abstract_Wallet(PrintError):
                     c -= v
                 else:
                     u -= v
-        return c, u, x
+        return c, u, x, low, high
+
+    def _refresh_balances(self):
+        '''Recompute the balances of the addresses that changed, or whose
+        coinbase coins matured since they were computed.  Callers hold
+        self.lock and self.transaction_lock.'''
+        local_height = self.get_local_height()
+        with self._balance_lock:
+            expired = []
+            if not self._balance_low <= local_height < self._balance_high:
+                expired = [addr for addr in self._balance_coinbase
+                           if not self._balances[addr][3] <= local_height < self._balances[addr][4]]
+        for addr in expired:
+            self._invalidate_balance(addr)
+        while True:
+            with self._balance_lock:
+                if not self._balance_dirty:
+                    break
+                addr = self._balance_dirty.pop()
+            if not self.is_mine(addr):
+                continue
+            entry = self._compute_addr_balance(addr, local_height)
+            with self._balance_lock:
+                if addr in self._balance_dirty:
+                    # changed meanwhile, computed again
+                    continue
+                self._balances[addr] = entry
+                for i in range(3):
+                    self._balance_total[i] += entry[i]
+                if entry[3:] != (float('-inf'), float('inf')):
+                    self._balance_coinbase.add(addr)
+        with self._balance_lock:
+            entries = [self._balances[addr] for addr in self._balance_coinbase]
+            self._balance_low = max([e[3] for e in entries], default=float('-inf'))
+            self._balance_high = min([e[4] for e in entries], default=float('inf'))
+
+    # return the balance of a bitcoin address: confirmed and matured, unconfirmed, unmatured
+    def get_addr_balance(self, address):
+        with self.lock, self.transaction_lock:
+            self._refresh_balances()
+            with self._balance_lock:
+                entry = self._balances.get(address)
+            if entry is None:
+                if self.is_mine(address):
+                    # no transactions
+                    return 0, 0, 0
+                entry = self._compute_addr_balance(address, self.get_local_height())
+            return entry[0], entry[1], entry[2]
 
     def get_spendable_coins(self, domain, config):
         confirmed_only = config.get('confirmed_only', False)
@@ -705,12 +906,15 @@ class Abstract_Wallet(PrintError):
             domain = self.get_addresses()
         if exclude_frozen:
             domain = set(domain) - self.frozen_addresses
+        local_height = self.get_local_height()
         for addr in domain:
+            if addr not in self._utxos:
+                continue
             utxos = self.get_addr_utxo(addr)
             for x in utxos.values():
                 if confirmed_only and x['height'] <= 0:
                     continue
-                if mature and x['coinbase'] and x['height'] + COINBASE_MATURITY > self.get_local_height():
+                if mature and x['coinbase'] and x['height'] + COINBASE_MATURITY > local_height:
                     continue
                 coins.append(x)
                 continue
@@ -726,18 +930,26 @@ class Abstract_Wallet(PrintError):
         return out
 
     def get_frozen_balance(self):
-        return self.get_balance(self.frozen_addresses)
+        with self.lock, self.transaction_lock:
+            self._refresh_balances()
+            key = frozenset(self.frozen_addresses), self._balance_version
+            if self._frozen_balance is None or self._frozen_balance[0] != key:
+                self._frozen_balance = key, self.get_balance(self.frozen_addresses)
+            return self._frozen_balance[1]
 
     def get_balance(self, domain=None):
-        if domain is None:
-            domain = self.get_addresses()
-        cc = uu = xx = 0
-        for addr in domain:
-            c, u, x = self.get_addr_balance(addr)
-            cc += c
-            uu += u
-            xx += x
-        return cc, uu, xx
+        with self.lock, self.transaction_lock:
+            self._refresh_balances()
+            if domain is None:
+                with self._balance_lock:
+                    return tuple(self._balance_total)
+            cc = uu = xx = 0
+            for addr in domain:
+                c, u, x = self.get_addr_balance(addr)
+                cc += c
+                uu += u
+                xx += x
+            return cc, uu, xx
 
     def get_address_history(self, addr):
         h = []
@@ -752,13 +964,16 @@ class Abstract_Wallet(PrintError):
 
     def _add_tx_to_local_history(self, txid):
         with self.transaction_lock:
+            self._history_dirty.add(txid)
             for addr in itertools.chain(self.txi.get(txid, []), self.txo.get(txid, [])):
                 cur_hist = self._history_local.get(addr, set())
                 cur_hist.add(txid)
                 self._history_local[addr] = cur_hist
+                self._local_history_addrs.setdefault(txid, set()).add(addr)
 
     def _remove_tx_from_local_history(self, txid):
         with self.transaction_lock:
+            self._history_dirty.add(txid)
             for addr in itertools.chain(self.txi.get(txid, []), self.txo.get(txid, [])):
                 cur_hist = self._history_local.get(addr, set())
                 try:
@@ -767,6 +982,10 @@ class Abstract_Wallet(PrintError):
                     pass
                 else:
                     self._history_local[addr] = cur_hist
+                    addrs = self._local_history_addrs[txid]
+                    addrs.discard(addr)
+                    if not addrs:
+                        self._local_history_addrs.pop(txid)
 
     def get_txin_address(self, txi):
         addr = txi.get('address')
@@ -868,6 +1087,9 @@ class Abstract_Wallet(PrintError):
                 for tx_hash2 in to_remove:
                     self.remove_transaction(tx_hash2)
             # add inputs
+            for addr, l in self.txi.get(tx_hash, {}).items():
+                for ser, v in l:
+                    self._remove_spend_from_utxo_index(addr, ser)
             self.txi[tx_hash] = d = {}
             for txi in tx.inputs():
                 addr = self.get_txin_address(txi)
@@ -885,10 +1107,16 @@ class Abstract_Wallet(PrintError):
                             if d.get(addr) is None:
                                 d[addr] = []
                             d[addr].append((ser, v))
+                            self._add_spend_to_utxo_index(addr, ser)
+                            self._add_spend(tx_hash, ser, addr)
                             break
                     else:
                         self.pruned_txo[ser] = tx_hash
+                        self._add_spend(tx_hash, ser, None)
             # add outputs
+            for addr, l in self.txo.get(tx_hash, {}).items():
+                for n, v, is_cb in l:
+                    self._remove_coin_from_utxo_index(addr, tx_hash, n)
             self.txo[tx_hash] = d = {}
             for n, txo in enumerate(tx.outputs()):
                 v = txo[2]
@@ -898,6 +1126,7 @@ class Abstract_Wallet(PrintError):
                     if d.get(addr) is None:
                         d[addr] = []
                     d[addr].append((n, v, is_coinbase))
+                    self._add_coin_to_utxo_index(addr, tx_hash, n, v, is_coinbase)
                 # give v to txi that spends me
                 next_tx = self.pruned_txo.get(ser)
                 if next_tx is not None:
@@ -906,10 +1135,17 @@ class Abstract_Wallet(PrintError):
                     if dd.get(addr) is None:
                         dd[addr] = []
                     dd[addr].append((ser, v))
+                    self._add_spend_to_utxo_index(addr, ser)
+                    self._add_spend(next_tx, ser, addr)
                     self._add_tx_to_local_history(next_tx)
             # add to local history
             self._add_tx_to_local_history(tx_hash)
             # save
+            if self._children is not None:
+                old_tx = self.transactions.get(tx_hash)
+                if old_tx is not None:
+                    self._remove_children(tx_hash, old_tx)
+                self._add_children(tx_hash, tx)
             self.transactions[tx_hash] = tx
             return True
 
@@ -917,34 +1153,41 @@ class Abstract_Wallet(PrintError):
 
         with self.transaction_lock:
             self.print_error("removing tx from history", tx_hash)
-            self.transactions.pop(tx_hash, None)
+            tx = self.transactions.pop(tx_hash, None)
+            if tx is not None and self._children is not None:
+                self._remove_children(tx_hash, tx)
             # undo spent_outpoints that are in txi
             for addr, l in self.txi[tx_hash].items():
                 for ser, v in l:
                     self.spent_outpoints.pop(ser, None)
+                    self._remove_spend_from_utxo_index(addr, ser)
             # undo spent_outpoints that are in pruned_txo
-            for ser, hh in list(self.pruned_txo.items()):
-                if hh == tx_hash:
+            for ser in list(self._spends_by_tx.get(tx_hash, [])):
+                if self.pruned_txo.get(ser) == tx_hash:
                     self.spent_outpoints.pop(ser, None)
                     self.pruned_txo.pop(ser)
+                self._remove_spend(tx_hash, ser)
 
             self._remove_tx_from_local_history(tx_hash)
 
             # add tx to pruned_txo, and undo the txi addition
-            for next_tx, dd in self.txi.items():
-                for addr, l in list(dd.items()):
-                    ll = l[:]
-                    for item in ll:
-                        ser, v = item
-                        prev_hash, prev_n = ser.split(':')
-                        if prev_hash == tx_hash:
-                            l.remove(item)
-                            self.pruned_txo[ser] = next_tx
-                    if l == []:
-                        dd.pop(addr)
-                    else:
-                        dd[addr] = l
+            for ser, (next_tx, addr) in list(self._spends_by_prevout.get(tx_hash, {}).items()):
+                dd = self.txi.get(next_tx, {})
+                l = dd.get(addr, [])
+                for item in l:
+                    if item[0] == ser:
+                        l.remove(item)
+                        self.pruned_txo[ser] = next_tx
+                        self._add_spend(next_tx, ser, None)
+                        self._history_dirty.add(next_tx)
+                        self._remove_spend_from_utxo_index(addr, ser)
+                        break
+                if addr in dd and l == []:
+                    dd.pop(addr)
 
+            for addr, l in self.txo.get(tx_hash, {}).items():
+                for n, v, is_cb in l:
+                    self._remove_coin_from_utxo_index(addr, tx_hash, n)
             self.txi.pop(tx_hash, None)
             self.txo.pop(tx_hash, None)
 
@@ -960,6 +1203,7 @@ class Abstract_Wallet(PrintError):
                     # make tx local
                     self.unverified_tx.pop(tx_hash, None)
                     self.verified_tx.pop(tx_hash, None)
+                    self._invalidate_tx(tx_hash)
                     if self.verifier:
                         self.verifier.merkle_roots.pop(tx_hash, None)
                     # but remove completely if not is_mine
@@ -979,10 +1223,156 @@ class Abstract_Wallet(PrintError):
         # Store fees
         self.tx_fees.update(tx_fees)
 
+    def reset_history_cache(self):
+        # history of the wallet, in the order of get_txpos: the rows are
+        # (tx_hash, height, timestamp, is_verified, delta), and the columns
+        # hold the running sum of the deltas (None counted as 0) and bounds
+        # of the timestamps for the range queries of _get_history_rows
+        self._history_keys = []
+        self._history_rows = []
+        self._history_sums = []
+        self._history_max_ts = []   # max timestamp of the rows up to i
+        self._history_min_ts = []   # min timestamp of the rows from i
+        self._history_txpos = {}    # tx_hash -> key
+        self._history_pruned = set()  # rows with a None delta
+        # rows to update; everything after a reset
+        self._history_dirty = set(itertools.chain(self.txi, self.txo))
+
+    def _make_history_row(self, tx_hash):
+        addrs = [addr for addr in self._local_history_addrs.get(tx_hash, [])
+                 if self.is_mine(addr)]
+        if not addrs:
+            return None
+        # a spend of an output we do not have yet leaves the delta unknown
+        if any(self.pruned_txo.get(ser) == tx_hash for ser in self._spends_by_tx.get(tx_hash, ())):
+            delta = None
+        else:
+            delta = sum(self.get_tx_delta(tx_hash, addr) for addr in addrs)
+        height, conf, timestamp = self.get_tx_height(tx_hash)
+        return tx_hash, height, timestamp, tx_hash in self.verified_tx, delta
+
+    def _refresh_history(self):
+        '''Move the rows of the transactions that changed, and update the
+        columns past the first moved row.  Callers hold self.lock and
+        self.transaction_lock.'''
+        if not self._history_dirty:
+            return
+        dirty, self._history_dirty = self._history_dirty, set()
+        keys, rows = self._history_keys, self._history_rows
+        columns = self._history_sums, self._history_max_ts, self._history_min_ts
+        # the rows before lo and the last tail rows are not moved
+        lo = len(keys)
+        tail = len(keys)
+        for tx_hash in dirty:
+            key = self._history_txpos.pop(tx_hash, None)
+            if key is None:
+                continue
+            i = bisect_left(keys, key)
+            tail = min(tail, len(keys) - i - 1)
+            lo = min(lo, i)
+            del keys[i], rows[i]
+            for column in columns:
+                del column[i]
+            self._history_pruned.discard(tx_hash)
+        for tx_hash in dirty:
+            row = self._make_history_row(tx_hash)
+            if row is None:
+                continue
+            key = self.get_txpos(tx_hash), tx_hash
+            i = bisect_right(keys, key)
+            tail = min(tail, len(keys) - i)
+            lo = min(lo, i)
+            keys.insert(i, key)
+            rows.insert(i, row)
+            for column in columns:
+                column.insert(i, None)
+            self._history_txpos[tx_hash] = key
+            if row[4] is None:
+                self._history_pruned.add(tx_hash)
+        inf = float('inf')
+        # running sums and max timestamps of the rows from lo
+        s = self._history_sums[lo - 1] if lo > 0 else 0
+        m = self._history_max_ts[lo - 1] if lo > 0 else -inf
+        for i in range(lo, len(keys)):
+            delta, timestamp = rows[i][4], rows[i][2]
+            s += delta or 0
+            m = max(m, inf if timestamp is None else timestamp)
+            self._history_sums[i] = s
+            self._history_max_ts[i] = m
+        # min timestamps, down to the first row that does not change
+        m = self._history_min_ts[len(keys) - tail] if tail else inf
+        for i in range(len(keys) - tail - 1, -1, -1):
+            timestamp = rows[i][2]
+            m = min(m, -inf if timestamp is None else timestamp)
+            if i < lo and self._history_min_ts[i] == m:
+                break
+            self._history_min_ts[i] = m
+
+    def _get_history_rows(self, from_timestamp=None, to_timestamp=None, before=None, limit=None):
+        '''Rows of the wallet history between the timestamps, newest first,
+        in the format of get_history, with their keys.  With before, only
+        the rows older than that key; at most limit rows.  The bounds are
+        found by bisection.'''
+        with self.lock, self.transaction_lock:
+            self._refresh_history()
+            keys, rows, sums = self._history_keys, self._history_rows, self._history_sums
+            if not keys:
+                return []
+            c, u, x = self.get_balance()
+            balance = c + u + x
+            # balances before the last row with an unknown delta are unknown
+            first_known = max([bisect_left(keys, self._history_txpos[tx_hash])
+                               for tx_hash in self._history_pruned], default=-1)
+            if first_known < 0 and balance != sums[-1]:
+                # fixme: this may happen if history is incomplete
+                self.print_error("Error: history not synchronized")
+                return []
+            lo, hi = 0, len(keys)
+            now = time.time()
+            if from_timestamp:
+                lo = bisect_left(self._history_max_ts, from_timestamp)
+            if to_timestamp:
+                # min_ts is not decreasing
+                hi = bisect_left(self._history_min_ts, to_timestamp)
+            if before is not None:
+                hi = min(hi, bisect_left(keys, before))
+            local_height = self.get_local_height()
+            out = []
+            for i in range(hi - 1, lo - 1, -1):
+                if limit is not None and len(out) >= limit:
+                    break
+                tx_hash, height, timestamp, is_verified, delta = rows[i]
+                if from_timestamp and (timestamp or now) < from_timestamp:
+                    continue
+                if to_timestamp and (timestamp or now) >= to_timestamp:
+                    continue
+                conf = max(local_height - height + 1, 0) if is_verified else 0
+                b = balance - sums[-1] + sums[i] if i >= first_known else None
+                out.append((keys[i], (tx_hash, height, conf, timestamp, delta, b)))
+            return out
+
+    def iter_history(self, from_timestamp=None, to_timestamp=None, before=None):
+        '''Generator over the wallet history, newest first, in the format
+        of get_history.  before is a txid: start with the transaction
+        that precedes it, e.g. the last one of a previous page.
+        The history is read by chunks, so it is not locked meanwhile.'''
+        key = None
+        if before is not None:
+            with self.lock, self.transaction_lock:
+                self._refresh_history()
+                key = self._history_txpos.get(before)
+            if key is None:
+                raise Exception('Transaction not in history: ' + before)
+        while True:
+            rows = self._get_history_rows(from_timestamp, to_timestamp, key, HISTORY_CHUNK_SIZE)
+            for key, row in rows:
+                yield row
+            if len(rows) < HISTORY_CHUNK_SIZE:
+                return
+
     def get_history(self, domain=None):
-        # get domain
         if domain is None:
-            domain = self.get_addresses()
+            return [row for key, row in reversed(self._get_history_rows())]
         # 1. Get the history of each address in the domain, maintain the
         #    delta of a tx as the sum of its deltas on domain addresses
         tx_deltas = defaultdict(int)
@@ -1031,6 +1421,48 @@ class Abstract_Wallet(PrintError):
         # return last balance
         return balance
 
+    def get_history_item(self, row, fx=None, show_addresses=False):
+        '''Detail a row of get_history, as in get_full_history'''
+        from .util import timestamp_to_datetime, Satoshis, Fiat
+        tx_hash, height, conf, timestamp, value, balance = row
+        item = {
+            'txid':tx_hash,
+            'height':height,
+            'confirmations':conf,
+            'timestamp':timestamp,
+            'value': Satoshis(value),
+            'balance': Satoshis(balance)
+        }
+        item['date'] = timestamp_to_datetime(timestamp)
+        item['label'] = self.get_label(tx_hash)
+        if show_addresses:
+            tx = self.transactions.get(tx_hash)
+            tx.deserialize()
+            input_addresses = []
+            output_addresses = []
+            for x in tx.inputs():
+                if x['type'] == 'coinbase': continue
+                addr = self.get_txin_address(x)
+                if addr is None:
+                    continue
+                input_addresses.append(addr)
+            for addr, v in tx.get_outputs():
+                output_addresses.append(addr)
+            item['input_addresses'] = input_addresses
+            item['output_addresses'] = output_addresses
+        if fx and fx.is_enabled() and value is not None:
+            fiat_value = self.get_fiat_value(tx_hash, fx.ccy)
+            fiat_default = fiat_value is None
+            fiat_value = fiat_value if fiat_value is not None else value / Decimal(COIN) * self.price_at_timestamp(tx_hash, fx.timestamp_rate)
+            item['fiat_value'] = Fiat(fiat_value, fx.ccy)
+            item['fiat_default'] = fiat_default
+            if value < 0:
+                acquisition_price = - value / Decimal(COIN) * self.average_price(tx_hash, fx.timestamp_rate, fx.ccy)
+                liquidation_price = - fiat_value
+                item['acquisition_price'] = Fiat(acquisition_price, fx.ccy)
+                item['capital_gain'] = Fiat(liquidation_price - acquisition_price, fx.ccy)
+        return item
+
     @profiler
     def get_full_history(self, domain=None, from_timestamp=None, to_timestamp=None, fx=None, show_addresses=False):
         from .util import timestamp_to_datetime, Satoshis, Fiat
@@ -1040,40 +1472,19 @@ class Abstract_Wallet(PrintError):
         capital_gains = Decimal(0)
         fiat_income = Decimal(0)
         fiat_expenditures = Decimal(0)
-        h = self.get_history(domain)
+        if domain is None:
+            h = [row for key, row in reversed(self._get_history_rows(from_timestamp, to_timestamp))]
+        else:
+            h = self.get_history(domain)
         for tx_hash, height, conf, timestamp, value, balance in h:
             if from_timestamp and (timestamp or time.time()) < from_timestamp:
                 continue
             if to_timestamp and (timestamp or time.time()) >= to_timestamp:
                 continue
-            item = {
-                'txid':tx_hash,
-                'height':height,
-                'confirmations':conf,
-                'timestamp':timestamp,
-                'value': Satoshis(value),
-                'balance': Satoshis(balance)
-            }
-            item['date'] = timestamp_to_datetime(timestamp)
-            item['label'] = self.get_label(tx_hash)
-            if show_addresses:
-                tx = self.transactions.get(tx_hash)
-                tx.deserialize()
-                input_addresses = []
-                output_addresses = []
-                for x in tx.inputs():
-                    if x['type'] == 'coinbase': continue
-                    addr = self.get_txin_address(x)
-                    if addr is None:
-                        continue
-                    input_addresses.append(addr)
-                for addr, v in tx.get_outputs():
-                    output_addresses.append(addr)
-                item['input_addresses'] = input_addresses
-                item['output_addresses'] = output_addresses
             # value may be None if wallet is not fully synchronized
             if value is None:
                 continue
+            item = self.get_history_item((tx_hash, height, conf, timestamp, value, balance), fx, show_addresses)
             # fixme: use in and out values
             if value < 0:
                 expenditures += -value
@@ -1081,19 +1492,9 @@ class Abstract_Wallet(PrintError):
                 income += value
             # fiat computations
             if fx and fx.is_enabled():
-                date = timestamp_to_datetime(timestamp)
-                fiat_value = self.get_fiat_value(tx_hash, fx.ccy)
-                fiat_default = fiat_value is None
-                fiat_value = fiat_value if fiat_value is not None else value / Decimal(COIN) * self.price_at_timestamp(tx_hash, fx.timestamp_rate)
-                item['fiat_value'] = Fiat(fiat_value, fx.ccy)
-                item['fiat_default'] = fiat_default
+                fiat_value = item['fiat_value'].value
                 if value < 0:
-                    acquisition_price = - value / Decimal(COIN) * self.average_price(tx_hash, fx.timestamp_rate, fx.ccy)
-                    liquidation_price = - fiat_value
-                    item['acquisition_price'] = Fiat(acquisition_price, fx.ccy)
-                    cg = liquidation_price - acquisition_price
-                    item['capital_gain'] = Fiat(cg, fx.ccy)
-                    capital_gains += cg
+                    capital_gains += item['capital_gain'].value
                     fiat_expenditures += -fiat_value
                 else:
                     fiat_income += fiat_value
@@ -1699,11 +2100,14 @@ class Abstract_Wallet(PrintError):
     def get_depending_transactions(self, tx_hash):
         """Returns all (grand-)children of tx_hash in this wallet."""
         children = set()
-        for other_hash, tx in self.transactions.items():
-            for input in (tx.inputs()):
-                if input["prevout_hash"] == tx_hash:
-                    children.add(other_hash)
-                    children |= self.get_depending_transactions(other_hash)
+        with self.transaction_lock:
+            if self._children is None:
+                self._children = {}
+                for other_hash, tx in self.transactions.items():
+                    self._add_children(other_hash, tx)
+            for other_hash in self._children.get(tx_hash, ()):
+                children.add(other_hash)
+                children |= self.get_depending_transactions(other_hash)
         return children
 
     def txin_value(self, txin):
@@ -1898,6 +2302,9 @@ class Imported_Wallet(Simple_Wallet):
 
         pubkey = self.get_public_key(address)
         self.addresses.pop(address)
+        self._invalidate_balance(address)
+        with self.transaction_lock:
+            self.reset_history_cache()
         if pubkey:
             # delete key iff no other address uses it (e.g. p2pkh and p2wpkh for same key)
             for txin_type in bitcoin.SCRIPT_TYPES.keys():